@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''Measures how long jpkg takes to start.  Run it from two checkouts (e.g.
+before and after a change) to compare them:
+
+    python3 benchmarks/startup.py [-n RUNS] [PKG]
+
+With PKG, it also times "jpkg-build --pretend PKG", which reads the
+configuration, the repository index and the package database and prints
+the build plan.  JPKG_CONFIG is used as usual.'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def time_command(command, runs, env):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='jpkg startup benchmark')
+    argparser.add_argument('-n', '--runs', type=int, default=20,
+            help='number of times to run each command')
+    argparser.add_argument('package', metavar='PKG', nargs='?',
+            help='package to show the build plan for')
+    args = argparser.parse_args()
+
+    source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([source_dir] +
+                ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    env['PYTHONWARNINGS'] = 'ignore'
+    jpkg_build = [sys.executable, os.path.join(source_dir, 'jpkg-build')]
+
+    commands = [
+        ('python (no jpkg)', [sys.executable, '-c', 'pass']),
+        ('import jpkg', [sys.executable, '-c', 'import jpkg']),
+        ('import jpkg, Config', [sys.executable, '-c',
+                    'import os, jpkg; jpkg.Config(os.environ["JPKG_CONFIG"])']),
+        ('jpkg-build --help', jpkg_build + ['--help']),
+    ]
+    if args.package:
+        commands.append(('jpkg-build --pretend %s' % args.package,
+                    jpkg_build + ['--pretend', args.package]))
+
+    print('%-40s %10s %10s' % ('command', 'min', 'median'))
+    for name, command in commands:
+        if 'JPKG_CONFIG' not in env and 'Config' in name:
+            continue
+        fastest, median = time_command(command, args.runs, env)
+        print('%-40s %8.1fms %8.1fms' % (name, 1000*fastest, 1000*median))
+
+
+if __name__ == '__main__':
+    main()
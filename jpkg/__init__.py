@@ -1,17 +1,70 @@
-from jpkg.buildscript import Buildscript
-from jpkg.config import Config
-from jpkg.depgraph import topological_sort
-from jpkg.installpaths import InstallPaths
-from jpkg.jbuild import Jbuild
-from jpkg.listfile import ListFile
-from jpkg.module import Module
-from jpkg.packagedb import PackageDB
-from jpkg.utils import get_jbuild_fullname, \
-            get_dependencies, \
-            download_file, \
-            yesno_prompt, \
-            make_recursive_dir, \
-            recursive_remove_dir, \
-            is_trailing_path_equal, \
-            error, \
-            status
+import importlib
+
+
+# Where each of the package's public names is defined.  The modules are only
+# imported when one of their names is first used, so that commands that only
+# need a few of them start quickly.
+_EXPORTS = {
+    'BinaryCache' : 'binarycache',
+    'BuildHistory' : 'buildhistory',
+    'Buildscript' : 'buildscript',
+    'BuildError' : 'buildscript',
+    'Config' : 'config',
+    'topological_sort' : 'depgraph',
+    'topological_levels' : 'depgraph',
+    'critical_path' : 'depgraph',
+    'CycleError' : 'depgraph',
+    'DependencyGraph' : 'depgraph',
+    'DistfileStore' : 'distfilestore',
+    'EnvironmentSnapshot' : 'envsnapshot',
+    'HashCache' : 'hashcache',
+    'ChecksumError' : 'hashcache',
+    'InstallPaths' : 'installpaths',
+    'SqliteInstallPaths' : 'installpaths',
+    'open_install_paths' : 'installpaths',
+    'Jbuild' : 'jbuild',
+    'Linker' : 'linker',
+    'install_packages' : 'linker',
+    'ListFile' : 'listfile',
+    'Module' : 'module',
+    'ModuleIndex' : 'moduleindex',
+    'PackageDB' : 'packagedb',
+    'DistfilePrefetcher' : 'prefetch',
+    'RepoIndex' : 'repoindex',
+    'BuildScheduler' : 'scheduler',
+    'SearchIndex' : 'searchindex',
+    'get_scratch_roots' : 'scratch',
+    'estimate_build_footprint' : 'scratch',
+    'reserve_scratch_root' : 'scratch',
+    'release_scratch_root' : 'scratch',
+    'Trash' : 'trash',
+    'SourceUnpacker' : 'unpack',
+    'get_jbuild_fullname' : 'utils',
+    'get_dependencies' : 'utils',
+    'version_key' : 'utils',
+    'sort_versions' : 'utils',
+    'download_file' : 'utils',
+    'file_digests' : 'utils',
+    'file_digest' : 'utils',
+    'yesno_prompt' : 'utils',
+    'make_recursive_dir' : 'utils',
+    'recursive_remove_dir' : 'utils',
+    'get_tree_size' : 'utils',
+    'format_size' : 'utils',
+    'parse_size' : 'utils',
+    'is_trailing_path_equal' : 'utils',
+    'error' : 'utils',
+    'status' : 'utils',
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module 'jpkg' has no attribute '%s'" % name)
+    value = getattr(importlib.import_module('jpkg.' + _EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
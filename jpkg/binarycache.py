@@ -0,0 +1,74 @@
+import os
+import tarfile
+
+import jpkg
+
+
+class BinaryCache:
+    '''A directory (local or on a shared filesystem) of packed install
+    directories, keyed by the hash of everything that went into building
+    them.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.cache_dir = config.get('binary_cache_dir')
+
+
+    def isEnabled(self):
+        return bool(self.cache_dir)
+
+
+    def getCacheFile(self, jbuild):
+        return os.path.join(self.cache_dir, jbuild.getName(),
+                    '%s-%s.tar.gz' % (jbuild.getNameAndVersion(), jbuild.getBuildHash()))
+
+
+    def fetch(self, jbuild):
+        '''Unpacks the cached build of jbuild into its install directory.
+        Returns False if the cache doesn't have it.'''
+        cache_file = self.getCacheFile(jbuild)
+        if not os.path.isfile(cache_file):
+            return False
+
+        installdir = jbuild.getInstallDir()
+        tmp_installdir = installdir + '.unpacking'
+        if os.path.isdir(tmp_installdir):
+            jpkg.recursive_remove_dir(tmp_installdir)
+        os.mkdir(tmp_installdir)
+        with tarfile.open(cache_file, 'r:gz') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(tmp_installdir, filter='tar')
+            else:
+                tar.extractall(tmp_installdir)
+
+        if os.path.isdir(installdir):
+            jpkg.recursive_remove_dir(installdir)
+        os.rename(tmp_installdir, installdir)
+        return True
+
+
+    def publish(self, jbuild):
+        '''Packs the install directory of jbuild into the cache.  Failing to
+        do so (e.g. because the cache is full or read-only) is reported but
+        doesn't fail the build.'''
+        cache_file = self.getCacheFile(jbuild)
+        if os.path.isfile(cache_file):
+            return
+
+        # Write to a temporary file first so that other nodes sharing the cache
+        # never see a partially written file
+        tmp_cache_file = '%s.%s.%d.part' % (cache_file, os.uname().nodename, os.getpid())
+        installdir = jbuild.getInstallDir()
+        try:
+            jpkg.make_recursive_dir(os.path.dirname(cache_file))
+            with tarfile.open(tmp_cache_file, 'w:gz') as tar:
+                for f in sorted(os.listdir(installdir)):
+                    tar.add(os.path.join(installdir, f), arcname=f)
+            os.replace(tmp_cache_file, cache_file)
+        except (OSError, tarfile.TarError) as e:
+            jpkg.error('error: could not add %s to the binary cache: %s' \
+                        % (jbuild.getNameAndVersion(), e))
+            try:
+                os.remove(tmp_cache_file)
+            except OSError:
+                pass
@@ -0,0 +1,57 @@
+import json
+import threading
+
+
+class BuildHistory:
+    '''Append-only log of builds, one JSON record per line.'''
+
+    _lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+    def append(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with BuildHistory._lock:
+            with open(self.filename, 'a') as fid:
+                fid.write(line)
+
+
+    def getRecords(self, name=None):
+        '''Returns all records (or only those for package name), oldest
+        first.'''
+        records = []
+        try:
+            with open(self.filename, 'r') as fid:
+                for line in fid:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # partially written line
+                    if name is None or record['name'] == name:
+                        records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+
+    def getLatestRecords(self):
+        '''Returns a dictionary mapping "name-version" and "name" to the most
+        recent record for each.'''
+        latest = {}
+        for record in self.getRecords():
+            latest[record['name']] = record
+            latest['%s-%s' % (record['name'], record['version'])] = record
+        return latest
+
+
+    def getEstimatedDuration(self, jbuild, latest=None):
+        '''Returns the wall time of the last build of this version of the
+        package, or of any version if this one was never built, or None.'''
+        if latest is None:
+            latest = self.getLatestRecords()
+        for key in [jbuild.getNameAndVersion(), jbuild.getName()]:
+            if key in latest:
+                return latest[key]['wall']
+        return None
@@ -1,16 +1,37 @@
 import os
+import re
+import resource
+import shutil
 import stat
 import subprocess
 import sys
+import tarfile
+import time
+import zipfile
 
 import jpkg
 
 
+PHASES = ['src_unpack', 'src_prepare', 'src_configure', 'src_compile',
+          'src_install', 'src_postinstall']
+
+
+class BuildError(Exception):
+    pass
+
+
+def parse_bash_time(string):
+    # Parses a time printed by bash's "times" builtin, e.g. "1m2.500s"
+    minutes, seconds = string.rstrip('s').split('m')
+    return 60*int(minutes) + float(seconds)
+
+
 class Buildscript:
-    def __init__(self, config, jbuild, filename):
+    def __init__(self, config, jbuild, filename, logfile=None):
         self.config = config
         self.jbuild = jbuild
         self.filename = filename
+        self.logfile = logfile
 
         if self.filename:
             with open(self.filename, 'r') as fid:
@@ -18,60 +39,182 @@ class Buildscript:
         else:
             self.script = ''
 
-        self.workdir = os.path.join(self.config.get('tmp_dir'), self.jbuild.getNameAndVersion())
+        self.setWorkdirRoot(self.config.get('tmp_dir'))
+        self.compiler_cache_stats = None
+        self.reserved_size = 0
+
+        self.dependency_env_vars = None
+
+        # Resources used by each phase that has been run, in order
+        self.phase_stats = {}
+        self.last_rusage = None
+
+
+    def setWorkdirRoot(self, root):
+        '''Sets the directory that the workdir is created in.'''
+        self.workdir_root = root
+        self.workdir = os.path.join(root, self.jbuild.getNameAndVersion())
         self.compiledir = os.path.join(self.workdir, self.jbuild.getCompileDir())
+        self.cwd = self.workdir
+        self.compiler_cache_statslog = os.path.join(self.workdir, '.compiler-cache-stats')
+
+
+    def getCompilerCacheEnvironment(self):
+        '''Returns the environment variables that route CC, CXX and FC through
+        the compiler cache (e.g. ccache), or an empty list if it's disabled.'''
+        compiler_cache = self.config.get('compiler_cache')
+        if not compiler_cache:
+            return []
+        compiler_cache_path = shutil.which(compiler_cache)
+        if compiler_cache_path is None:
+            message = 'error: compiler_cache "%s" not found.' % compiler_cache
+            jpkg.error(message)
+            raise BuildError(message)
+
+        cache_dir = self.config.get('compiler_cache_dir')
+        jpkg.make_recursive_dir(cache_dir)
+        return [
+            'CC=%s %s' % (compiler_cache_path, self.config.get('c_compiler')),
+            'CXX=%s %s' % (compiler_cache_path, self.config.get('cxx_compiler')),
+            'FC=%s %s' % (compiler_cache_path, self.config.get('fortran_compiler')),
+            'CCACHE_DIR=%s' % cache_dir,
+            'CCACHE_MAXSIZE=%s' % self.config.get('compiler_cache_size'),
+            # Rewrite absolute paths below the workdir root to relative ones so
+            # that rebuilds in a fresh workdir still hit the cache
+            'CCACHE_BASEDIR=%s' % self.workdir_root,
+            'CCACHE_STATSLOG=%s' % self.compiler_cache_statslog,
+        ]
+
+
+    def readCompilerCacheStats(self):
+        '''Counts the cache hits and misses in the compiler cache's statistics
+        log (one line per result, with "#" lines naming the source file).'''
+        hits = 0
+        misses = 0
+        try:
+            with open(self.compiler_cache_statslog, 'r') as fid:
+                for line in fid:
+                    line = line.strip()
+                    if line.startswith('#'):
+                        continue
+                    if line.endswith('cache_hit'):
+                        hits += 1
+                    elif line.endswith('cache_miss'):
+                        misses += 1
+        except FileNotFoundError:
+            pass
+        return {'hits' : hits, 'misses' : misses}
+
+
+    def makeEnvironmentCommand(self):
+        '''Returns the command that runs a program in the clean build
+        environment.'''
+        return ['env', '-i', '--',
+                'PATH=/usr/bin:/bin',
+                'HOME=%s' % os.getenv('HOME'),
+                'USER=%s' % os.getenv('USER'),
+                'CFLAGS=%s' % self.config.get('cflags'),
+                'CXXFLAGS=%s' % self.config.get('cxxflags'),
+                'FCFLAGS=%s' % self.config.get('fcflags'),
+                'LANG=C',
+                'LC_CTYPE=C',
+                'LC_NUMERIC=C',
+                'LC_TIME=C',
+                'LC_COLLATE=C',
+                'LC_MONETARY=C',
+                'LC_MESSAGES=C',
+                'LC_PAPER=C',
+                'LC_NAME=C',
+                'LC_ADDRESS=C',
+                'LC_TELEPHONE=C',
+                'LC_MEASUREMENT=C',
+                'LC_IDENTIFICATION=C'] \
+                + self.getCompilerCacheEnvironment()
 
 
     def runBashCode(self, code_string):
-        p = subprocess.Popen(['env', '-i', '--',
-                        'PATH=/usr/bin:/bin',
-                        'HOME=%s' % os.getenv('HOME'),
-                        'USER=%s' % os.getenv('USER'),
-                        'CFLAGS=%s' % self.config.get('cflags'),
-                        'CXXFLAGS=%s' % self.config.get('cxxflags'),
-                        'FCFLAGS=%s' % self.config.get('fcflags'),
-                        'LANG=C',
-                        'LC_CTYPE=C',
-                        'LC_NUMERIC=C',
-                        'LC_TIME=C',
-                        'LC_COLLATE=C',
-                        'LC_MONETARY=C',
-                        'LC_MESSAGES=C',
-                        'LC_PAPER=C',
-                        'LC_NAME=C',
-                        'LC_ADDRESS=C',
-                        'LC_TELEPHONE=C',
-                        'LC_MEASUREMENT=C',
-                        'LC_IDENTIFICATION=C',
-                        'bash', '--norc', '--noprofile'],
-                        universal_newlines=True, stdin=subprocess.PIPE)
-        p.communicate(input=code_string)
+        if self.logfile:
+            output = open(self.logfile, 'a')
+        else:
+            output = None
+        p = subprocess.Popen(self.makeEnvironmentCommand() \
+                        + ['bash', '--norc', '--noprofile'],
+                        universal_newlines=True, stdin=subprocess.PIPE,
+                        stdout=output, stderr=output, cwd=self.cwd)
+        try:
+            p.stdin.write(code_string)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        # Wait with wait4 to get the resource usage of this bash process and
+        # its children alone, even when other builds are running concurrently
+        pid, status, self.last_rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        if output:
+            output.close()
         return p.returncode
 
 
     def build(self):
+        # Put the workdir on the fastest scratch filesystem with enough space
+        root, self.reserved_size = jpkg.reserve_scratch_root(self.config, self.jbuild)
+        self.setWorkdirRoot(root)
+        try:
+            self.buildInWorkdir()
+        finally:
+            jpkg.release_scratch_root(root, self.reserved_size)
+
+
+    def buildInWorkdir(self):
         try:
             os.mkdir(self.workdir)
         except FileExistsError:
-            jpkg.recursive_remove_dir(self.workdir)
+            self.config.getTrash().remove(self.workdir)
             os.mkdir(self.workdir)
-        os.chdir(self.workdir)
-
-        self.src_unpack()
-
-        if self.jbuild.getCompileDir() != 'NONE':
-            os.chdir(self.compiledir)
-        self.src_prepare()
-        self.src_configure()
-        self.src_compile()
-        self.src_install()
-        self.src_postinstall()
-
-        jpkg.recursive_remove_dir(self.workdir)
-
-
-    def runBuildFunc(self, funcname):
-        print('\nRunning %s...' % funcname)
+        self.cwd = self.workdir
+
+        # Unpack the distfiles in Python unless the buildscript does it itself
+        unpacker = jpkg.SourceUnpacker(self.config)
+        native_unpack = self.config.get('native_unpack') \
+                    and not self.definesFunction('src_unpack') \
+                    and unpacker.canUnpack(self.jbuild)
+        phases = PHASES
+        if native_unpack:
+            self.unpackNatively(unpacker)
+            phases = PHASES[1:]
+
+        if self.config.get('single_bash_session'):
+            self.runBuildSession(phases)
+        else:
+            if not native_unpack:
+                self.src_unpack()
+
+            if self.jbuild.getCompileDir() != 'NONE':
+                self.cwd = self.compiledir
+            self.src_prepare()
+            self.src_configure()
+            self.src_compile()
+            self.src_install()
+            self.src_postinstall()
+
+        if self.config.get('compiler_cache'):
+            self.compiler_cache_stats = self.readCompilerCacheStats()
+
+        # The workdir is measured while the trash deletes it, so that the
+        # next build doesn't wait for a walk of it
+        record = {
+            'name' : self.jbuild.getName(),
+            'version' : self.jbuild.getVersion(),
+            'timestamp' : time.time(),
+        }
+        self.config.getTrash().remove(self.workdir, self.reserved_size,
+                    record=(self.config.getWorkdirSizesFile(), record))
+
+
+    def makeScript(self):
+        '''Returns the bash code that defines the build environment and all
+        of the build functions.'''
         code = self.makeCommonInitializationScript() + '\n'
 
         base_buildscript = self.jbuild.getBaseBuildscript()
@@ -85,16 +228,158 @@ class Buildscript:
             raise ValueError('Invalid base_buildscript: "%s".' % base_buildscript)
 
         code += self.script + '\n'
+        return code
+
+
+    def runBuildFunc(self, funcname):
+        self.log('\nRunning %s...' % funcname)
+        code = self.makeScript()
         #code += 'set -x\n' # TODO DEBUG REMOVE
         code += 'env\n' # TODO DEBUG REMOVE
         #code += 'exit\n' # TODO DEBUG REMOVE
         code += funcname + '\n'
         #print(code) # TODO DEBUG REMOVE
+        start_time = time.time()
         returncode = self.runBashCode(code)
+        self.phase_stats[funcname] = {
+            'wall' : time.time() - start_time,
+            'utime' : self.last_rusage.ru_utime,
+            'stime' : self.last_rusage.ru_stime,
+            'maxrss' : self.last_rusage.ru_maxrss, # kilobytes
+        }
         if returncode != 0:
-            jpkg.error('error: %s failed while building "%s".' \
-                        % (funcname, self.jbuild.getNameAndVersion()))
-            exit(1)
+            message = 'error: %s failed while building "%s".' \
+                        % (funcname, self.jbuild.getNameAndVersion())
+            if self.logfile:
+                message += '  See "%s".' % self.logfile
+            jpkg.error(message)
+            raise BuildError(message)
+
+
+    def definesFunction(self, funcname):
+        '''Returns True if the buildscript defines the bash function.'''
+        return re.search(r'^\s*(function\s+%s\b|%s\s*\(\s*\))' % (funcname, funcname),
+                    self.script, re.MULTILINE) is not None
+
+
+    def unpackNatively(self, unpacker):
+        self.log('\nUnpacking %s...' % ' '.join(self.jbuild.getDistfiles()))
+        start_time = time.time()
+        start_rusage = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            unpacker.unpack(self.jbuild, self.workdir)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            message = 'error: src_unpack failed while building "%s": %s' \
+                        % (self.jbuild.getNameAndVersion(), e)
+            jpkg.error(message)
+            raise BuildError(message)
+        end_rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.phase_stats['src_unpack'] = {
+            'wall' : time.time() - start_time,
+            # Approximate, since this process may be running other builds
+            'utime' : end_rusage.ru_utime - start_rusage.ru_utime,
+            'stime' : end_rusage.ru_stime - start_rusage.ru_stime,
+            'maxrss' : None,
+        }
+
+
+    def runBuildSession(self, phases=PHASES):
+        '''Runs all of the build functions in a single bash process, so the
+        initialization script only runs once and variables set by one build
+        function are still set in the later ones.  Bash reports the start,
+        exit status and CPU time of each function through a pipe.'''
+        status_read, status_write = os.pipe()
+        code = self.makeScript()
+        code += '''
+            function jpkg_run_phase {
+                # Printed by bash so that it comes before the phase's output
+                printf '\\nRunning %%s...\\n' "$1"
+                echo "begin $1" >&%(fd)d
+                "$1" %(fd)d>&-
+                local status=$?
+                echo "end $1 $status" >&%(fd)d
+                times >&%(fd)d
+                return $status
+            }
+            ''' % {'fd' : status_write}
+        in_compiledir = False
+        for funcname in phases:
+            if funcname != 'src_unpack' and not in_compiledir \
+                        and self.jbuild.getCompileDir() != 'NONE':
+                code += 'cd "%s" || exit $?\n' % self.compiledir
+                in_compiledir = True
+            code += 'jpkg_run_phase %s || exit $?\n' % funcname
+
+        script_filename = os.path.join(self.workdir, '.jpkg-build-session.bash')
+        with open(script_filename, 'w') as fid:
+            fid.write(code)
+
+        if self.logfile:
+            output = open(self.logfile, 'a')
+        else:
+            output = None
+        p = subprocess.Popen(self.makeEnvironmentCommand() \
+                        + ['bash', '--norc', '--noprofile', script_filename],
+                        stdin=subprocess.DEVNULL, stdout=output, stderr=output,
+                        cwd=self.workdir, pass_fds=(status_write,))
+        os.close(status_write)
+
+        current_phase = None
+        failed_phase = None
+        # "times" is cumulative, so subtract what earlier phases used
+        cpu_utime = 0.0
+        cpu_stime = 0.0
+        with os.fdopen(status_read, 'r') as status:
+            while True:
+                line = status.readline()
+                if not line:
+                    break
+                words = line.split()
+                if words[0] == 'begin':
+                    current_phase = words[1]
+                    start_time = time.time()
+                elif words[0] == 'end':
+                    wall = time.time() - start_time
+                    if words[2] != '0':
+                        failed_phase = current_phase
+                    # "times" prints the user and system time of the shell,
+                    # then of its children
+                    times = [parse_bash_time(t) for t in \
+                                (status.readline() + status.readline()).split()]
+                    utime = times[0] + times[2]
+                    stime = times[1] + times[3]
+                    self.phase_stats[current_phase] = {
+                        'wall' : wall,
+                        'utime' : utime - cpu_utime,
+                        'stime' : stime - cpu_stime,
+                        'maxrss' : None, # not available per phase
+                    }
+                    cpu_utime = utime
+                    cpu_stime = stime
+                    current_phase = None
+
+        pid, wait_status, self.last_rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(wait_status)
+        if output:
+            output.close()
+
+        if p.returncode != 0 or failed_phase:
+            # A phase that began but never ended called "exit"
+            funcname = failed_phase or current_phase or 'initialization'
+            message = 'error: %s failed while building "%s".' \
+                        % (funcname, self.jbuild.getNameAndVersion())
+            if self.logfile:
+                message += '  See "%s".' % self.logfile
+            jpkg.error(message)
+            raise BuildError(message)
+
+
+    def log(self, message):
+        if self.logfile:
+            with open(self.logfile, 'a') as fid:
+                fid.write(message + '\n')
+        else:
+            print(message)
 
 
     def src_unpack(self):
@@ -121,14 +406,21 @@ class Buildscript:
         self.runBuildFunc('src_postinstall')
 
 
+    def makeDependencyEnvironmentScript(self):
+        # Generate path environment variables for dependencies.  This is the
+        # same for every build function, so only do it once.
+        if self.dependency_env_vars is None:
+            self.dependency_env_vars = ''
+            module = jpkg.Module()
+            for dep in self.jbuild.getDependencies():
+                j = jpkg.Jbuild(self.config, dep)
+                self.dependency_env_vars += module.getEnvironmentVariablesForBash(
+                            j.getInstallDir(), name=j.getName()) + '\n'
+        return self.dependency_env_vars
+
+
     def makeCommonInitializationScript(self):
-        # Generate path environment variables for dependencies
-        dependency_env_vars = ''
-        deps = self.jbuild.getDependencies()
-        module = jpkg.Module()
-        for dep in deps:
-            j = jpkg.Jbuild(self.config, dep)
-            dependency_env_vars += module.getEnvironmentVariablesForBash(j.getInstallDir(), name=j.getName()) + '\n'
+        dependency_env_vars = self.makeDependencyEnvironmentScript()
 
         return '\n'.join([
             # Environment variables
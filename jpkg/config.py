@@ -1,15 +1,31 @@
 import json
 import os
+import threading
 
 import jpkg
 
 
+# Directories that are created the first time they're used
+DIRECTORY_KEYS = ['distfiles_dir', 'package_install_dir', 'config_dir', 'database_dir',
+                  'modulefile_dir', 'tmp_dir', 'usr_dir']
+
+
 class Config:
     def __init__(self, filename):
         self.filename = filename
+        self.created_dirs = set()
 
         jpkg_base_dir = os.path.join(os.path.dirname(self.filename))
         self.config = {}
+        # Guards the objects below, which are created on first use, possibly
+        # by several build or download threads at once
+        self.lock = threading.RLock()
+        self.repo_index = None
+        self.hash_cache = None
+        self.distfile_store = None
+        self.trash = None
+        self.module_index = None
+        self.search_index = None
 
         # Set defaults
         self.config['distfiles_dir'] = os.path.join(jpkg_base_dir, 'distfiles')
@@ -19,15 +35,52 @@ class Config:
         self.config['database_dir'] = os.path.join(jpkg_base_dir, 'var')
         self.config['modulefile_dir'] = os.path.join(jpkg_base_dir, 'modulefiles')
         self.config['tmp_dir'] = os.path.join(jpkg_base_dir, 'tmp')
+        # Where the Lmod spider cache for modulefile_dir is written; defaults to
+        # .lmod-cache in modulefile_dir if empty
+        self.config['lmod_cache_dir'] = ''
         self.config['usr_dir'] = os.path.join(jpkg_base_dir, 'usr')
         self.config['use'] = ''
         self.config['makeopts'] = ''
         self.config['cflags'] = ''
         self.config['cxxflags'] = ''
         self.config['fcflags'] = ''
-        #self.config['c_compiler'] = ''
-        #self.config['cxx_compiler'] = ''
-        #self.config['fortran_compiler'] = ''
+        self.config['fetch_jobs'] = 4
+        # Base URLs to try before a distfile's own URL, in order
+        self.config['mirrors'] = []
+        # Size that --distfiles-gc shrinks distfiles_dir to, by evicting the
+        # least recently used distfiles that no package in the package database
+        # uses
+        self.config['distfiles_max_size'] = '20G'
+        self.config['installed_paths_backend'] = 'json' # or 'sqlite'
+        self.config['binary_cache_dir'] = '' # disabled if empty
+        # Directories to build in, fastest first (e.g. ["/dev/shm/jpkg",
+        # "/tmp/jpkg"]).  The first one with enough free space for the build is
+        # used, and tmp_dir is used if none of them has enough.
+        self.config['scratch_dirs'] = []
+        # Workdirs are renamed into a trash directory and deleted in the
+        # background, as long as the trash holds less than this.  '0' deletes
+        # them right away.
+        self.config['trash_max_size'] = '20G'
+        # Unpack distfiles in Python, through a cache of extracted source trees
+        # if source_cache_dir is set
+        self.config['native_unpack'] = True
+        self.config['source_cache_dir'] = '' # no cache if empty
+        # Size that --distfiles-gc shrinks source_cache_dir to, by evicting the
+        # least recently used source trees
+        self.config['source_cache_max_size'] = '10G'
+        # How workdirs are populated from the source cache: 'copy' (copy-on-write
+        # where the filesystem supports it) or 'hardlink' (fastest, but builds
+        # that modify files in place also modify the cache)
+        self.config['source_cache_clone'] = 'copy'
+        # Run all build phases of a package in one bash process
+        self.config['single_bash_session'] = False
+        self.config['compiler_cache'] = '' # e.g. 'ccache', disabled if empty
+        self.config['compiler_cache_dir'] = os.path.join(jpkg_base_dir, 'ccache')
+        self.config['compiler_cache_size'] = '5G'
+        # Compilers called through compiler_cache
+        self.config['c_compiler'] = 'cc'
+        self.config['cxx_compiler'] = 'c++'
+        self.config['fortran_compiler'] = 'gfortran'
 
         try:
             with open(filename, 'r') as fid:
@@ -38,17 +91,12 @@ class Config:
             jpkg.make_recursive_dir(jpkg_base_dir)
             self.save()
 
-        # Create directories if they don't exist yet
-        jpkg.make_recursive_dir(self.config['distfiles_dir'])
-        jpkg.make_recursive_dir(self.config['package_install_dir'])
-        jpkg.make_recursive_dir(self.config['config_dir'])
-        jpkg.make_recursive_dir(self.config['database_dir'])
-        jpkg.make_recursive_dir(self.config['modulefile_dir'])
-        jpkg.make_recursive_dir(self.config['tmp_dir'])
-        jpkg.make_recursive_dir(self.config['usr_dir'])
-
 
     def get(self, key):
+        if key in DIRECTORY_KEYS and key not in self.created_dirs:
+            # Create directories if they don't exist yet
+            jpkg.make_recursive_dir(self.config[key])
+            self.created_dirs.add(key)
         return self.config[key]
 
 
@@ -70,8 +118,67 @@ class Config:
                 self.config[key] = self.config[key].replace('${CONFIGPATH}', CONFIGPATH)
 
 
+    def getBuildHistoryFile(self):
+        return os.path.join(self.get('database_dir'), 'build_history.jsonl')
+
+
+    def getWorkdirSizesFile(self):
+        return os.path.join(self.get('database_dir'), 'workdir_sizes.jsonl')
+
+
+    def getRepoIndex(self):
+        with self.lock:
+            if self.repo_index is None:
+                self.repo_index = jpkg.RepoIndex(self)
+            return self.repo_index
+
+
+    def getHashCache(self):
+        with self.lock:
+            if self.hash_cache is None:
+                self.hash_cache = jpkg.HashCache(
+                            os.path.join(self.get('database_dir'), 'distfile_hashes.json'))
+            return self.hash_cache
+
+
+    def getDistfileStore(self):
+        with self.lock:
+            if self.distfile_store is None:
+                self.distfile_store = jpkg.DistfileStore(self)
+            return self.distfile_store
+
+
+    def getTrash(self):
+        with self.lock:
+            if self.trash is None:
+                self.trash = jpkg.Trash(self)
+            return self.trash
+
+
+    def getModuleIndex(self):
+        with self.lock:
+            if self.module_index is None:
+                self.module_index = jpkg.ModuleIndex(self)
+            return self.module_index
+
+
+    def getSearchIndex(self):
+        with self.lock:
+            if self.search_index is None:
+                self.search_index = jpkg.SearchIndex(self)
+            return self.search_index
+
+
     def getInstallPathsDbFile(self):
-        return os.path.join(self.get('database_dir'), 'installed_paths.json')
+        backend = self.get('installed_paths_backend')
+        if backend == 'json':
+            return os.path.join(self.get('database_dir'), 'installed_paths.json')
+        elif backend == 'sqlite':
+            return os.path.join(self.get('database_dir'), 'installed_paths.sqlite')
+        else:
+            jpkg.error('error: Invalid "installed_paths_backend" in %s: "%s".' \
+                        % (self.filename, backend))
+            exit(1)
 
 
 if __name__ == '__main__':
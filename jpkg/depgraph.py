@@ -1,31 +1,187 @@
+class CycleError(Exception):
+    def __init__(self, cycle):
+        # cycle: List of objects, starting and ending with the same object,
+        #        where each object depends on the next one.
+        self.cycle = cycle
+        Exception.__init__(self, 'dependency cycle: %s' \
+                    % ' -> '.join([str(x) for x in cycle]))
+
+
+def _make_adjacency(objects, dependencies):
+    index = {}
+    for idx, obj in enumerate(objects):
+        index[obj] = idx
+    return [[index[d] for d in deps] for deps in dependencies]
+
+
+def _sorted_indices(objects, adjacency):
+    # Depth-first search with an explicit stack, so deep chains don't hit
+    # Python's recursion limit.  Returns the indices of objects in the order
+    # they should be built.
+    UNVISITED, IN_PROGRESS, DONE = 0, 1, 2
+    state = [UNVISITED for i in objects]
+    sorted_indices = []
+
+    for start in range(len(objects)):
+        if state[start] != UNVISITED:
+            continue
+        state[start] = IN_PROGRESS
+        stack = [(start, 0)]
+        while stack:
+            idx, next_edge = stack[-1]
+            if next_edge < len(adjacency[idx]):
+                stack[-1] = (idx, next_edge + 1)
+                dep = adjacency[idx][next_edge]
+                if state[dep] == IN_PROGRESS:
+                    path = [i for i, e in stack]
+                    cycle = path[path.index(dep):] + [dep]
+                    raise CycleError([objects[i] for i in cycle])
+                if state[dep] == UNVISITED:
+                    state[dep] = IN_PROGRESS
+                    stack.append((dep, 0))
+            else:
+                stack.pop()
+                state[idx] = DONE
+                sorted_indices.append(idx)
+
+    return sorted_indices
+
+
 def topological_sort(objects, dependencies):
     # Performs a topological sort (using the depth-first search algorithm).
-    # objects: List of strings.
-    # dependencies: List of lists of strings, order matching objects so that
+    # objects: List of hashable objects (e.g. strings).
+    # dependencies: List of lists of objects, order matching objects so that
     #               dependencies[i] is a list of the dependencies of objects[i].
-    # Returns the objects in the order they should be built.
-    marks_permanent = [False for i in objects]
-    marks_temp = [False for i in objects]
-    sorted_list = []
-
-    while False in marks_permanent:
-        for idx in range(len(marks_permanent)):
-            if not marks_permanent[idx]:
-                toposort_visit(idx, objects, dependencies, marks_permanent,
-                        marks_temp, sorted_list)
-
-    return sorted_list
-
-
-def toposort_visit(idx, objects, dependencies, marks_permanent, marks_temp,
-        sorted_list):
-    if marks_temp[idx]:
-        raise Exception("not a directed acyclic graph, cannot be topologically sorted.")
-    if not marks_permanent[idx]:
-        marks_temp[idx] = True
-        for other_name in dependencies[idx]:
-            toposort_visit(objects.index(other_name), objects, dependencies,
-                    marks_permanent, marks_temp, sorted_list)
-        marks_permanent[idx] = True
-        marks_temp[idx] = False
-        sorted_list.append(objects[idx])
+    # Returns the objects in the order they should be built.  Raises
+    # CycleError if there is a dependency cycle.
+    adjacency = _make_adjacency(objects, dependencies)
+    return [objects[idx] for idx in _sorted_indices(objects, adjacency)]
+
+
+def topological_levels(objects, dependencies):
+    # Groups the objects into levels, where each level only depends on the
+    # levels before it, so everything in a level can be built concurrently.
+    # Arguments are the same as for topological_sort.
+    # Returns a list of lists of objects.
+    adjacency = _make_adjacency(objects, dependencies)
+    level = [0 for i in objects]
+    for idx in _sorted_indices(objects, adjacency):
+        for dep in adjacency[idx]:
+            level[idx] = max(level[idx], level[dep] + 1)
+
+    levels = [[] for i in range(max(level, default=-1) + 1)]
+    for idx, obj in enumerate(objects):
+        levels[level[idx]].append(obj)
+    return levels
+
+
+def critical_path(objects, dependencies, weights):
+    # Finds the chain of dependencies with the largest total weight, which is
+    # a lower bound on the time to build everything no matter how many
+    # packages are built at once.
+    # objects, dependencies: Same as for topological_sort.
+    # weights: List of numbers, order matching objects (e.g. build durations).
+    # Returns (total weight, list of objects on the path in build order).
+    adjacency = _make_adjacency(objects, dependencies)
+    finish = [0 for i in objects]
+    previous = [None for i in objects]
+    for idx in _sorted_indices(objects, adjacency):
+        for dep in adjacency[idx]:
+            if previous[idx] is None or finish[dep] > finish[previous[idx]]:
+                previous[idx] = dep
+        finish[idx] = weights[idx]
+        if previous[idx] is not None:
+            finish[idx] += finish[previous[idx]]
+
+    if not objects:
+        return 0, []
+    idx = max(range(len(objects)), key=lambda i: finish[i])
+    total = finish[idx]
+    path = []
+    while idx is not None:
+        path.append(objects[idx])
+        idx = previous[idx]
+    path.reverse()
+    return total, path
+
+
+class DependencyGraph:
+    def __init__(self):
+        self.nodes = []             # jbuilds, in the order they were added
+        self.node_by_spec = {}      # jbuild spec -> jbuild
+        self.edges = {}             # jbuild spec -> list of dependency jbuilds
+        self.reverse_edges = {}     # jbuild spec -> list of dependent jbuilds
+
+
+    def __contains__(self, jbuild):
+        return jbuild.jbuild_spec in self.node_by_spec
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+    def addNode(self, jbuild):
+        '''Adds jbuild to the graph if it isn't there yet, and returns the
+        jbuild object the graph uses for that spec.'''
+        spec = jbuild.jbuild_spec
+        if spec not in self.node_by_spec:
+            self.nodes.append(jbuild)
+            self.node_by_spec[spec] = jbuild
+            self.edges[spec] = []
+            self.reverse_edges[spec] = []
+        return self.node_by_spec[spec]
+
+
+    def addEdge(self, jbuild, dependency):
+        '''Records that jbuild depends on dependency.  Both must already be
+        in the graph.'''
+        if dependency not in self.edges[jbuild.jbuild_spec]:
+            self.edges[jbuild.jbuild_spec].append(dependency)
+            self.reverse_edges[dependency.jbuild_spec].append(jbuild)
+
+
+    def getNodes(self):
+        return self.nodes
+
+
+    def getDependencies(self, jbuild):
+        return self.edges[jbuild.jbuild_spec]
+
+
+    def getDependents(self, jbuild):
+        return self.reverse_edges[jbuild.jbuild_spec]
+
+
+    def getDependencyLists(self):
+        '''Returns the dependencies of every node, in the format used by
+        topological_sort.'''
+        return [self.edges[jbuild.jbuild_spec] for jbuild in self.nodes]
+
+
+    def _getSubgraphLists(self, jbuilds):
+        if jbuilds is None:
+            return self.nodes, self.getDependencyLists()
+        selected = set(jbuilds)
+        return jbuilds, [[d for d in self.getDependencies(j) if d in selected]
+                    for j in jbuilds]
+
+
+    def topologicalSort(self):
+        return topological_sort(self.nodes, self.getDependencyLists())
+
+
+    def getLevels(self, jbuilds=None):
+        '''Returns the jbuilds (default: all nodes) grouped into levels that
+        can be built concurrently.  Dependencies outside of jbuilds are
+        ignored.'''
+        objects, dependencies = self._getSubgraphLists(jbuilds)
+        return topological_levels(objects, dependencies)
+
+
+    def getCriticalPath(self, weight, jbuilds=None):
+        '''Returns (total weight, path) for the chain of jbuilds (default: all
+        nodes) with the largest total weight(jbuild).  Dependencies outside of
+        jbuilds are ignored.'''
+        objects, dependencies = self._getSubgraphLists(jbuilds)
+        return critical_path(objects, dependencies, [weight(j) for j in objects])
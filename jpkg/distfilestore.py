@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+
+import jpkg
+
+
+class DistfileStore:
+    '''Content-addressed store of distfiles.  Each distinct file is kept once,
+    as distfiles_dir/.store/<sha256>, and the names that jbuilds use for it
+    are symlinks to it.  The time each file was last used by a build is
+    recorded so that the garbage collector can evict the least recently used
+    files first.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.distdir = config.get('distfiles_dir')
+        self.store_dir = os.path.join(self.distdir, '.store')
+        self.filename = os.path.join(config.get('database_dir'), 'distfile_store.json')
+        self.lock = threading.RLock()
+        self.dirty = False
+
+        # sha256 -> {'size' : bytes, 'last_used' : seconds since the epoch}
+        self.database = {}
+        try:
+            with open(self.filename, 'r') as fid:
+                self.database = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filename = '%s.%d' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fid:
+                json.dump(self.database, fid, indent=2, sort_keys=True)
+                fid.write('\n')
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+
+
+    def getBlobPath(self, digest):
+        return os.path.join(self.store_dir, digest)
+
+
+    def getDigest(self, distfile):
+        '''Returns the sha256 of the stored file that distfile links to, or
+        None if distfile isn't a link into the store.'''
+        path = os.path.join(self.distdir, distfile)
+        if not os.path.islink(path):
+            return None
+        target = os.readlink(path)
+        if os.path.dirname(os.path.normpath(os.path.join(self.distdir, target))) \
+                    != os.path.normpath(self.store_dir):
+            return None
+        return os.path.basename(target)
+
+
+    def add(self, distfile):
+        '''Moves the downloaded file distfile into the store (or deletes it if
+        the store already has an identical file), replaces it with a link, and
+        marks it as used now.'''
+        path = os.path.join(self.distdir, distfile)
+        digest = self.getDigest(distfile)
+        if digest is None:
+            if os.path.islink(path):
+                return # a link the user made; leave it alone
+            digest = self.config.getHashCache().getDigest(path)
+            blob = self.getBlobPath(digest)
+            jpkg.make_recursive_dir(self.store_dir)
+            with self.lock:
+                if os.path.isfile(blob):
+                    os.remove(path)
+                else:
+                    os.rename(path, blob)
+                tmp_path = '%s.%d.link' % (path, os.getpid())
+                os.symlink(os.path.relpath(blob, os.path.dirname(path)), tmp_path)
+                os.replace(tmp_path, path)
+        self.touch(digest)
+
+
+    def touch(self, digest):
+        blob = self.getBlobPath(digest)
+        with self.lock:
+            self.database[digest] = {
+                'size' : os.path.getsize(blob),
+                'last_used' : time.time(),
+            }
+            self.dirty = True
+
+
+    def getBlobs(self):
+        '''Returns a dictionary mapping the sha256 of each stored file to its
+        size and last use time.'''
+        blobs = {}
+        try:
+            digests = os.listdir(self.store_dir)
+        except FileNotFoundError:
+            digests = []
+        for digest in digests:
+            st = os.stat(self.getBlobPath(digest))
+            with self.lock:
+                entry = self.database.get(digest)
+            if entry is None:
+                entry = {'size' : st.st_size, 'last_used' : st.st_mtime}
+            blobs[digest] = entry
+        return blobs
+
+
+    def getNames(self):
+        '''Returns a dictionary mapping the sha256 of each stored file to the
+        distfile names that link to it.'''
+        names = {}
+        for distfile in os.listdir(self.distdir):
+            digest = self.getDigest(distfile)
+            if digest is not None:
+                names.setdefault(digest, []).append(distfile)
+        return names
+
+
+    def getReferencedDigests(self, package_db):
+        '''Returns the set of sha256s of the stored files used by the packages
+        in package_db.'''
+        index = self.config.getRepoIndex()
+        referenced = set()
+        for name in package_db.database:
+            versions = index.getVersions(name)
+            for entry in package_db.database[name]:
+                if entry['version'] not in versions:
+                    continue # no longer in the repository
+                jbuild = jpkg.Jbuild(self.config, '=%s-%s' % (name, entry['version']))
+                for distfile in jbuild.getDistfiles():
+                    digest = self.getDigest(distfile)
+                    if digest is not None:
+                        referenced.add(digest)
+        return referenced
+
+
+    def collectGarbage(self, max_size, package_db, dry_run=False):
+        '''Evicts the least recently used stored files that no package in
+        package_db uses until the store is no bigger than max_size bytes, and
+        removes the links to them.  Returns a list of (sha256, size, names)
+        of the evicted files.'''
+        blobs = self.getBlobs()
+        names = self.getNames()
+        referenced = self.getReferencedDigests(package_db)
+        total = sum([blob['size'] for blob in blobs.values()])
+
+        candidates = [d for d in blobs if d not in referenced]
+        candidates.sort(key=lambda d: blobs[d]['last_used'])
+        evicted = []
+        for digest in candidates:
+            if total <= max_size:
+                break
+            evicted.append((digest, blobs[digest]['size'], names.get(digest, [])))
+            total -= blobs[digest]['size']
+            if dry_run:
+                continue
+            for distfile in names.get(digest, []):
+                os.remove(os.path.join(self.distdir, distfile))
+            os.remove(self.getBlobPath(digest))
+            with self.lock:
+                if digest in self.database:
+                    del self.database[digest]
+                    self.dirty = True
+
+        if not dry_run:
+            self.config.getHashCache().removeMissing()
+        return evicted
@@ -0,0 +1,83 @@
+import collections
+import os
+
+import jpkg
+
+
+class EnvironmentSnapshot:
+    '''The combined environment of a set of packages and all of their
+    dependencies, with each path appearing once, that can be written as a
+    single shell script or modulefile instead of loading a module per
+    package.'''
+
+    def __init__(self, config, jbuilds):
+        self.config = config
+        self.jbuilds = list(jbuilds)
+
+        # Packages that depend on others come first, so that their paths take
+        # precedence, like when their modules are loaded last
+        graph = jpkg.get_dependencies(config, self.jbuilds)
+        self.packages = list(reversed(graph.topologicalSort()))
+
+        module = jpkg.Module()
+        self.env_vars = collections.OrderedDict()
+        for jbuild in self.packages:
+            env_vars = module.getEnvironmentVariables(jbuild.getInstallDir())
+            for variable in sorted(env_vars):
+                paths = self.env_vars.setdefault(variable, [])
+                for path in env_vars[variable]:
+                    path = os.path.normpath(path)
+                    if path not in paths:
+                        paths.append(path)
+
+
+    def getMissingPackages(self):
+        '''Returns the packages in the snapshot that haven't been built.'''
+        return [j for j in self.packages if not os.path.isdir(j.getInstallDir())]
+
+
+    def getFlags(self):
+        '''Returns (variable, flags) for the compiler and linker flags that
+        the modulefiles also set.'''
+        flags = []
+        if 'LIBRARY_PATH' in self.env_vars:
+            flags.append(('LDFLAGS', ["-L'%s' -Wl,-rpath,'%s'" % (x, x)
+                        for x in self.env_vars['LIBRARY_PATH']]))
+        if 'CPATH' in self.env_vars:
+            for variable in ['CFLAGS', 'CXXFLAGS', 'FCFLAGS']:
+                flags.append((variable, ["-I'%s'" % x for x in self.env_vars['CPATH']]))
+        return flags
+
+
+    def getDescription(self):
+        return 'jpkg environment snapshot of %s' \
+                    % ' '.join([j.getNameAndVersion() for j in self.jbuilds])
+
+
+    def formatShell(self):
+        lines = ['# %s' % self.getDescription(),
+                 '# (%s)' % ' '.join([j.getNameAndVersion() for j in self.packages])]
+        for variable, paths in self.env_vars.items():
+            lines.append('export %s="%s${%s:+:${%s}}"' % (variable, ':'.join(paths),
+                        variable, variable))
+        for variable, flags in self.getFlags():
+            lines.append('export %s="%s${%s:+ ${%s}}"' % (variable, ' '.join(flags),
+                        variable, variable))
+        return '\n'.join(lines) + '\n'
+
+
+    def formatModule(self):
+        lines = ['#%Module 1.0',
+                 'module-whatis "%s"' % self.getDescription()]
+        for variable, paths in self.env_vars.items():
+            lines.append('prepend-path %s "%s"' % (variable, ':'.join(paths)))
+        for variable, flags in self.getFlags():
+            lines.append('prepend-path -d " " %s "%s"' % (variable, ' '.join(flags)))
+        return '\n'.join(lines) + '\n'
+
+
+    def format(self, format):
+        if format == 'module':
+            return self.formatModule()
+        else:
+            return self.formatShell()
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+
+import jpkg
+from jpkg.buildscript import BuildError
+
+
+class ChecksumError(BuildError):
+    '''A distfile doesn't match the digest given for it in its jbuild.'''
+    pass
+
+
+class HashCache:
+    '''Persistent cache of file digests.  Each entry records the size, mtime
+    and inode of the file when it was hashed, and is only used while they are
+    unchanged, so that multi-GB distfiles aren't hashed again on every
+    build.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.dirty = False
+
+        self.database = {}
+        try:
+            with open(self.filename, 'r') as fid:
+                self.database = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filename = '%s.%d' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fid:
+                json.dump(self.database, fid, indent=2, sort_keys=True)
+                fid.write('\n')
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+
+
+    def _getStat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+    def getDigests(self, path, algorithms=['sha256'], refresh=False):
+        '''Returns a dictionary mapping each algorithm to the hex digest of the
+        file at path, or None if the file doesn't exist.  Digests that aren't
+        in the cache (or all of them if refresh is True) are computed.'''
+        path = os.path.abspath(path)
+        stat = self._getStat(path)
+        if stat is None:
+            return None
+
+        with self.lock:
+            entry = self.database.get(path)
+            if entry is None or entry['stat'] != stat or refresh:
+                entry = {'stat' : stat, 'digests' : {}}
+            digests = dict(entry['digests'])
+
+        missing = [a for a in algorithms if a not in digests]
+        if missing:
+            digests.update(jpkg.file_digests(path, missing))
+            self.setDigests(path, digests, stat)
+        return dict([(a, digests[a]) for a in algorithms])
+
+
+    def getDigest(self, path, algorithm='sha256'):
+        digests = self.getDigests(path, [algorithm])
+        return digests[algorithm] if digests else None
+
+
+    def setDigests(self, path, digests, stat=None):
+        '''Records digests (a dictionary mapping algorithm to hex digest) of
+        the file at path, e.g. computed while it was downloaded.'''
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = self._getStat(path)
+        with self.lock:
+            entry = self.database.get(path)
+            if entry is None or entry['stat'] != stat:
+                entry = {'stat' : stat, 'digests' : {}}
+                self.database[path] = entry
+            entry['digests'].update(digests)
+            self.dirty = True
+
+
+    def removeMissing(self):
+        '''Forgets files that no longer exist.'''
+        with self.lock:
+            for path in list(self.database):
+                if not os.path.exists(path):
+                    del self.database[path]
+                    self.dirty = True
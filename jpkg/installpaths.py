@@ -1,10 +1,17 @@
+import contextlib
 import json
 import os.path
+import sqlite3
 
 
 class InstallPaths:
     def __init__(self, filename):
         self.filename = filename
+        self.batch_depth = 0
+        self._load()
+
+
+    def _load(self):
         self.database = {}
         try:
             with open(self.filename, 'r') as fid:
@@ -12,15 +19,53 @@ class InstallPaths:
         except FileNotFoundError:
             pass
 
+        # Reverse index from each path to the packages that contain it (only
+        # directories can be in more than one package)
+        self.owners = {}
+        for package in self.database:
+            self._indexPaths(package, self.database[package])
+
 
     def save(self):
+        if self.batch_depth > 0:
+            return # saved when the batch ends
         with open(self.filename, 'w') as fid:
             json.dump(self.database, fid, indent=2, sort_keys=True)
             fid.write('\n')
 
 
+    @contextlib.contextmanager
+    def batch(self):
+        '''Context manager that groups changes so that the database is only
+        written once, when the block finishes without an exception.'''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        self.save()
+
+
+    def _indexPaths(self, package, paths):
+        for path in paths:
+            if path not in self.owners:
+                self.owners[path] = []
+            self.owners[path].append(package)
+
+
+    def _unindexPaths(self, package, paths):
+        for path in paths:
+            owners = self.owners[path]
+            owners.remove(package)
+            if not owners:
+                del self.owners[path]
+
+
     def addPaths(self, package, paths):
+        if package in self.database:
+            self._unindexPaths(package, self.database[package])
         self.database[package] = [self.standardizePath(x) for x in paths]
+        self._indexPaths(package, self.database[package])
         self.save()
 
 
@@ -36,13 +81,197 @@ class InstallPaths:
 
 
     def getPackageContainingPath(self, path):
-        spath = self.standardizePath(path)
-        for package in self.database:
-            if spath in self.database[package]:
-                return package
+        owners = self.owners.get(self.standardizePath(path))
+        if owners:
+            return owners[0]
         return None
 
 
+    def getPackagesContainingPath(self, path):
+        return list(self.owners.get(self.standardizePath(path), []))
+
+
+    def getOwners(self, paths):
+        '''Returns a dictionary mapping each of the given paths that is
+        contained in a package to the name of that package.'''
+        result = {}
+        for path in paths:
+            owners = self.owners.get(self.standardizePath(path))
+            if owners:
+                result[path] = owners[0]
+        return result
+
+
+    def getReferenceCounts(self, paths):
+        '''Returns a dictionary mapping each of the given paths to the number
+        of packages that contain it.'''
+        result = {}
+        for path in paths:
+            result[path] = len(self.owners.get(self.standardizePath(path), []))
+        return result
+
+
     def removePackage(self, package):
+        self._unindexPaths(package, self.database[package])
         del self.database[package]
         self.save()
+
+
+class SqliteInstallPaths(InstallPaths):
+    '''InstallPaths stored in an SQLite database, so that changes don't have
+    to rewrite the whole database and loading it doesn't have to parse it.'''
+
+    # Stored in the database's user_version once it has been set up
+    SCHEMA_VERSION = 1
+
+    def __init__(self, filename, json_filename=None):
+        self.json_filename = json_filename
+        super().__init__(filename)
+
+
+    def _load(self):
+        self.connection = sqlite3.connect(self.filename)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        # Create the tables and import the JSON database in one transaction,
+        # and only mark the database as set up when all of it has been done,
+        # so that a failed migration is tried again the next time.  sqlite3
+        # doesn't start transactions for CREATE on its own.
+        migrate = self.json_filename and os.path.isfile(self.json_filename)
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS paths '
+                        '(package TEXT NOT NULL, path TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS paths_path ON paths (path)')
+            self.connection.execute(
+                        'CREATE INDEX IF NOT EXISTS paths_package ON paths (package)')
+
+            # One-time migration from the JSON database, which is only renamed
+            # once it has been imported
+            if migrate:
+                with open(self.json_filename, 'r') as fid:
+                    database = json.load(fid)
+                self.connection.execute('DELETE FROM paths')
+                for package in database:
+                    self._insertPaths(package, database[package])
+
+            self.connection.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+
+        if migrate:
+            os.rename(self.json_filename, self.json_filename + '.migrated')
+
+
+    def _insertPaths(self, package, paths):
+        self.connection.executemany('INSERT INTO paths (package, path) VALUES (?, ?)',
+                    [(package, path) for path in paths])
+
+
+    def save(self):
+        if self.batch_depth == 0:
+            self.connection.commit()
+
+
+    def addPaths(self, package, paths):
+        try:
+            self.connection.execute('DELETE FROM paths WHERE package = ?', (package,))
+            self._insertPaths(package, [self.standardizePath(x) for x in paths])
+        except:
+            self.connection.rollback()
+            raise
+        self.save()
+
+
+    def getPaths(self, package):
+        # A package that was installed without any paths of its own has no
+        # rows, like the empty list the JSON database has for it
+        rows = self.connection.execute(
+                    'SELECT path FROM paths WHERE package = ? ORDER BY rowid',
+                    (package,)).fetchall()
+        return [row[0] for row in rows]
+
+
+    def getPackageContainingPath(self, path):
+        row = self.connection.execute(
+                    'SELECT package FROM paths WHERE path = ? ORDER BY rowid LIMIT 1',
+                    (self.standardizePath(path),)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+
+    def getPackagesContainingPath(self, path):
+        rows = self.connection.execute(
+                    'SELECT package FROM paths WHERE path = ? ORDER BY rowid',
+                    (self.standardizePath(path),)).fetchall()
+        return [row[0] for row in rows]
+
+
+    def getOwners(self, paths):
+        '''Returns a dictionary mapping each of the given paths that is
+        contained in a package to the name of that package.'''
+        spaths = {}
+        for path in paths:
+            spaths[self.standardizePath(path)] = path
+
+        owners = {}
+        spath_list = list(spaths)
+        chunk_size = 500 # stay below SQLite's limit on query parameters
+        for i in range(0, len(spath_list), chunk_size):
+            chunk = spath_list[i:i+chunk_size]
+            rows = self.connection.execute(
+                        'SELECT path, package FROM paths WHERE path IN (%s) ORDER BY rowid' \
+                        % ','.join('?'*len(chunk)), chunk)
+            for spath, package in rows:
+                owners.setdefault(spath, package)
+
+        result = {}
+        for path in paths:
+            spath = self.standardizePath(path)
+            if spath in owners:
+                result[path] = owners[spath]
+        return result
+
+
+    def getReferenceCounts(self, paths):
+        spaths = {}
+        for path in paths:
+            spaths[self.standardizePath(path)] = path
+
+        counts = {}
+        spath_list = list(spaths)
+        chunk_size = 500
+        for i in range(0, len(spath_list), chunk_size):
+            chunk = spath_list[i:i+chunk_size]
+            rows = self.connection.execute(
+                        'SELECT path, COUNT(*) FROM paths WHERE path IN (%s) GROUP BY path' \
+                        % ','.join('?'*len(chunk)), chunk)
+            for spath, count in rows:
+                counts[spath] = count
+
+        result = {}
+        for path in paths:
+            result[path] = counts.get(self.standardizePath(path), 0)
+        return result
+
+
+    def removePackage(self, package):
+        self.connection.execute('DELETE FROM paths WHERE package = ?', (package,))
+        self.save()
+
+
+def open_install_paths(config):
+    '''Opens the installed paths database using the backend selected by the
+    "installed_paths_backend" configuration option.'''
+    backend = config.get('installed_paths_backend')
+    if backend == 'sqlite':
+        return SqliteInstallPaths(config.getInstallPathsDbFile(),
+                    json_filename=os.path.join(config.get('database_dir'),
+                    'installed_paths.json'))
+    else:
+        return InstallPaths(config.getInstallPathsDbFile())
@@ -1,6 +1,8 @@
+import hashlib
 import json
 import os
 import sys
+import time
 
 import jpkg
 
@@ -16,15 +18,21 @@ class Jbuild:
 
         self.jbuild_dir = os.path.dirname(self.jbuild_path)
 
-        with open(self.jbuild_path, 'r') as fid:
-            jbuild_text = fid.read()
-        self.jbuild = json.loads(self.variableSubstitute(jbuild_text))
+        self.jbuild = config.getRepoIndex().getJbuildData(self.jbuild_spec,
+                    lambda text: json.loads(self.variableSubstitute(text)))
+
+        # Compiler cache hits and misses of the last build, if it was enabled
+        self.compiler_cache_stats = None
 
 
     def __eq__(self, other):
         return self.jbuild_spec == other.jbuild_spec
 
 
+    def __hash__(self):
+        return hash(self.jbuild_spec)
+
+
     def __repr__(self):
         return self.getNameAndVersion()
 
@@ -59,6 +67,12 @@ class Jbuild:
                     self.getNameAndVersion())
 
 
+    def getMetadataDir(self):
+        '''Directory within the install directory where jpkg keeps information
+        about the build.  It is not linked into usr_dir.'''
+        return os.path.join(self.getInstallDir(), '.jpkg')
+
+
     def getUseFlags(self):
         if 'use' in self.jbuild:
             use = self.jbuild['use']
@@ -111,6 +125,12 @@ class Jbuild:
             return self.getName()
 
 
+    def getModuleFilename(self):
+        '''Where the package's modulefile is installed.'''
+        return os.path.join(self.config.get('modulefile_dir'), self.getModuleDestDir(),
+                    self.getVersion())
+
+
     def getCompileDir(self):
         '''The directory that the package extracts to.'''
         if 'compile_dir' in self.jbuild:
@@ -166,9 +186,10 @@ class Jbuild:
         else:
             base_buildscript = 'autotools'
         if base_buildscript not in ['autotools', 'cmake', 'python']:
-            jpkg.error('error: Invalid "base_buildscript" for package "%s".' \
-                        % self.getNameAndVersion());
-            exit(1)
+            message = 'error: Invalid "base_buildscript" for package "%s".' \
+                        % self.getNameAndVersion()
+            jpkg.error(message)
+            raise jpkg.BuildError(message)
         return base_buildscript
 
 
@@ -209,66 +230,165 @@ class Jbuild:
         return newstring
 
 
+    def getExpectedDistfileDigests(self, distfile):
+        '''Returns the digests of distfile given in the jbuild, e.g.
+        {"sha256": "..."}, which may be empty.'''
+        if 'digests' in self.jbuild:
+            return self.jbuild['digests'].get(distfile, {})
+        else:
+            return {}
+
+
+    def getDistfileDigest(self, distfile):
+        path = os.path.join(self.config.get('distfiles_dir'), distfile)
+        # None if not downloaded (e.g. a dependency that came from the binary
+        # cache)
+        return self.config.getHashCache().getDigest(path)
+
+
+    def verifyDistfile(self, distfile, refresh=False):
+        '''Returns the algorithms for which the downloaded distfile doesn't
+        match the digest in the jbuild.  The file must exist.'''
+        path = os.path.join(self.config.get('distfiles_dir'), distfile)
+        expected = self.getExpectedDistfileDigests(distfile)
+        actual = self.config.getHashCache().getDigests(path, sorted(expected),
+                    refresh=refresh)
+        return [a for a in sorted(expected) if expected[a].lower() != actual[a]]
+
+
+    def getBuildHash(self):
+        '''Returns a hash of everything that goes into building the package,
+        including the build hashes of its dependencies.'''
+        if hasattr(self, '_build_hash'):
+            return self._build_hash
+
+        with open(self.jbuild_path, 'r') as fid:
+            jbuild_text = fid.read()
+        buildscript_text = ''
+        if self.getBuildscript():
+            with open(self.getBuildscript(), 'r') as fid:
+                buildscript_text = fid.read()
+
+        distfile_digests = {}
+        for distfile in self.getDistfiles():
+            distfile_digests[distfile] = self.getDistfileDigest(distfile)
+
+        dependency_hashes = {}
+        for dep in self.getDependencies():
+            j = jpkg.Jbuild(self.config, dep)
+            dependency_hashes[j.getNameAndVersion()] = j.getInstalledBuildHash() \
+                        or j.getBuildHash()
+
+        inputs = {
+            'jbuild' : jbuild_text,
+            'buildscript' : buildscript_text,
+            'use' : sorted(self.getEnabledUseFlags()),
+            'cflags' : self.config.get('cflags'),
+            'cxxflags' : self.config.get('cxxflags'),
+            'fcflags' : self.config.get('fcflags'),
+            'install_dir' : self.getInstallDir(),
+            'distfiles' : distfile_digests,
+            'depends' : dependency_hashes,
+        }
+        self._build_hash = hashlib.sha256(
+                    json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+        return self._build_hash
+
+
+    def getInstalledBuildHash(self):
+        '''Returns the build hash recorded when the package was built, or None
+        if it hasn't been built (or was built by an older jpkg).'''
+        try:
+            with open(os.path.join(self.getMetadataDir(), 'build_hash'), 'r') as fid:
+                return fid.read().strip()
+        except FileNotFoundError:
+            return None
+
+
     def downloadDistfiles(self):
-        distdir = self.config.get('distfiles_dir')
         urls, distfiles = self._split_src_urls()
         for url, distfile in zip(urls, distfiles):
-            dest = os.path.join(distdir, distfile)
-            if not os.path.isfile(dest):
-                print('Downloading "%s"...' % url)
-                jpkg.download_file(url, dest)
-
-
-    def build(self):
+            self.downloadDistfile(url, distfile)
+
+
+    def downloadDistfile(self, url, distfile, quiet=False):
+        dest = os.path.join(self.config.get('distfiles_dir'), distfile)
+        if os.path.isfile(dest):
+            if not self.verifyDistfile(distfile):
+                self.config.getDistfileStore().add(distfile)
+                return
+            print('"%s" does not match its checksum, downloading it again...' % distfile)
+            os.remove(dest)
+        print('Downloading "%s"...' % url)
+        digests = jpkg.download_file(url, dest, quiet=quiet,
+                    mirrors=self.config.get('mirrors'),
+                    digests=self.getExpectedDistfileDigests(distfile))
+        self.config.getHashCache().setDigests(dest, digests)
+        self.config.getDistfileStore().add(distfile)
+
+
+    def build(self, logfile=None):
         '''Builds the package and installs it into its own directory within the
-        package_install_dir directory.'''
-        buildscript = jpkg.Buildscript(self.config, self, self.getBuildscript())
+        package_install_dir directory.  If logfile is given, the output of the
+        build is written to it instead of the terminal.'''
+        cache = jpkg.BinaryCache(self.config)
+        if cache.isEnabled() and cache.fetch(self):
+            jpkg.status('Unpacked %s from the binary cache.' % self.getNameAndVersion())
+            if jpkg.Module().readManifest(self.getInstallDir()) is None:
+                jpkg.Module().writeManifest(self.getInstallDir())
+            return
+
+        buildscript = jpkg.Buildscript(self.config, self, self.getBuildscript(),
+                    logfile=logfile)
+        start_time = time.time()
         buildscript.build()
+        self.compiler_cache_stats = buildscript.compiler_cache_stats
+
+        jpkg.make_recursive_dir(self.getMetadataDir())
+        with open(os.path.join(self.getMetadataDir(), 'build_hash'), 'w') as fid:
+            fid.write(self.getBuildHash() + '\n')
+        # Record where the package's bin, lib, etc. directories are so that
+        # dependent packages and modules don't have to search for them
+        jpkg.Module().writeManifest(self.getInstallDir())
+        self.recordBuildHistory(buildscript, start_time)
+
+        if cache.isEnabled():
+            cache.publish(self)
+
+
+    def recordBuildHistory(self, buildscript, start_time):
+        install_size, install_files = jpkg.get_tree_size(self.getInstallDir())
+        history = jpkg.BuildHistory(self.config.getBuildHistoryFile())
+        history.append({
+            'name' : self.getName(),
+            'version' : self.getVersion(),
+            'timestamp' : start_time,
+            'host' : os.uname().nodename,
+            'wall' : time.time() - start_time,
+            'phases' : buildscript.phase_stats,
+            'install_size' : install_size,
+            'install_files' : install_files,
+            'workdir_root' : buildscript.workdir_root,
+        })
 
 
     def install(self):
-        '''Puts symlinks to all the package's files in the usr_dir directory.'''
-        destroot = self.config.get('usr_dir')
-        srcroot = self.getInstallDir()
-        installpaths = jpkg.InstallPaths(self.config.getInstallPathsDbFile())
-
-        # Make sure there aren't any files that will be overwritten
-        for root, dirs, files in os.walk(srcroot, followlinks=True):
-            destfulldir = os.path.join(destroot, os.path.relpath(root, start=srcroot))
-            for f in files:
-                destfullpath = os.path.join(destfulldir, f)
-
-                # some files are in many packages, so ignore them
-                if jpkg.is_trailing_path_equal(3, destfullpath, 'share/info/dir'):
-                    continue
-                if jpkg.is_trailing_path_equal(2, destfullpath, 'site-packages/easy-install.pth'):
-                    continue
-                if jpkg.is_trailing_path_equal(2, destfullpath, 'site-packages/site.py'):
-                    continue
-                if jpkg.is_trailing_path_equal(2, destfullpath, 'site-packages/__pycache__/site.cpython-35.pyc'):
-                    continue
-
-                owning_package = installpaths.getPackageContainingPath(destfullpath)
-                if owning_package:
-                    jpkg.error('error: file "%s" already owned by %s.  Cannot install %s.' %
-                            (destfullpath, owning_package, self.getName()))
-                    exit(1)
-
-        # Install the files
-        installed_paths = []
-        for root, dirs, files in os.walk(srcroot, followlinks=True):
-            destfulldir = os.path.join(destroot, os.path.relpath(root, start=srcroot))
-            for f in files:
-                fullsrc = os.path.join(root, f)
-                destfullpath = os.path.join(destfulldir, f)
-                jpkg.make_recursive_dir(destfulldir)
-                if not os.path.exists(destfullpath):
-                    os.symlink(fullsrc, destfullpath)
-                    installed_paths.append(destfullpath)
-            for d in dirs:
-                destfullpath = os.path.join(destfulldir, d)
-                installed_paths.append(destfullpath+'/')
-        installpaths.addPaths(self.getName(), installed_paths)
+        '''Puts symlinks to all the package's files in the usr_dir directory.
+        Directories that no other package uses are linked as a whole.'''
+        jpkg.install_packages(self.config, [self])
+
+
+    def installModule(self):
+        '''Writes the package's modulefile to modulefile_dir and adds it to the
+        module index.'''
+        if os.path.isfile(self.getModule()):
+            module = jpkg.Module(self.getModule())
+        else:
+            module = jpkg.Module()
+        module_filename = self.getModuleFilename()
+        os.makedirs(os.path.dirname(module_filename), exist_ok=True)
+        module.write(module_filename, self.getInstallDir(), self.getDescription())
+        self.config.getModuleIndex().addModule(self, module_filename)
 
 
     def remove(self):
@@ -276,10 +396,10 @@ class Jbuild:
         jpkg.recursive_remove_dir(self.getInstallDir())
 
         # Remove module
-        module_dir = os.path.join(self.config.get('modulefile_dir'),
-                    self.getModuleDestDir())
-        if os.path.isdir(module_dir):
-            os.remove(os.path.join(module_dir, self.getVersion()))
+        module_dir = os.path.dirname(self.getModuleFilename())
+        self.config.getModuleIndex().removeModule(self.getModuleFilename())
+        if os.path.isfile(self.getModuleFilename()):
+            os.remove(self.getModuleFilename())
 
             # Remove module directory if it's empty
             if len(os.listdir(module_dir)) == 0:
@@ -287,26 +407,30 @@ class Jbuild:
 
 
     def uninstall(self):
-        installpaths = jpkg.InstallPaths(self.config.getInstallPathsDbFile())
+        installpaths = jpkg.open_install_paths(self.config)
         paths = installpaths.getPaths(self.getName())
 
-        # Remove all files
+        # Remove all files and folded directories
+        dirs = []
         for path in paths:
-            if path[-1] != '/':
+            if path[-1] == '/':
+                dirs.append(path)
+            else:
                 try:
                     os.remove(path)
                 except FileNotFoundError:
                     pass
 
-        # Remove empty directories if they don't belong to any other package
-        for counter in range(10): # lazy way to deal with recursive empty
-                                  # directories
-            for path in paths:
-                if path[-1] == '/' and os.path.isdir(path):
-                    if len(os.listdir(path)) == 0:
-                        owner = installpaths.getPackageContainingPath(path)
-                        if owner is None or owner == self.getName():
-                            os.rmdir(path)
+        # Remove directories that don't belong to any other package, deepest
+        # first so that their subdirectories are already gone
+        counts = installpaths.getReferenceCounts(dirs)
+        dirs.sort(key=lambda path: path.count('/'), reverse=True)
+        for path in dirs:
+            if counts[path] <= 1:
+                try:
+                    os.rmdir(path)
+                except OSError: # gone already, or has files jpkg didn't put there
+                    pass
 
         # Remove package from installpaths file
         installpaths.removePackage(self.getName())
@@ -0,0 +1,203 @@
+import os
+import stat
+
+import jpkg
+
+
+# Files that are in many packages, so only the first package to install them
+# gets them and nobody else conflicts with them
+SHARED_FILES = [
+    (3, 'share/info/dir'),
+    (2, 'site-packages/easy-install.pth'),
+    (2, 'site-packages/site.py'),
+    (2, 'site-packages/__pycache__/site.cpython-35.pyc'),
+]
+
+
+def is_shared_file(path):
+    for n, shared_path in SHARED_FILES:
+        if jpkg.is_trailing_path_equal(n, path, shared_path):
+            return True
+    return False
+
+
+class Linker:
+    '''Links the files of packages into usr_dir.  A directory that only one
+    package has files in is linked as a whole ("folded") instead of linking
+    each file in it, and a folded directory is split into a real directory of
+    links when a second package needs to put files in it.
+
+    Installing is done in two steps: planInstall checks a package for
+    conflicts and works out what has to be done without touching the
+    filesystem, and commit does it.  Several packages can be planned before
+    committing, and later plans take earlier ones into account.
+
+    In the installed paths database a package owns its file links, its
+    folded directory links (both without a trailing "/") and the real
+    directories it has files in (with a trailing "/").'''
+
+    def __init__(self, config, installpaths):
+        self.config = config
+        self.installpaths = installpaths
+        self.destroot = os.path.normpath(config.get('usr_dir'))
+
+        # Planned state of paths in usr_dir: path -> (kind, target, owner)
+        # where kind is 'dir' or 'link'
+        self.planned = {}
+        # Planned changes, in order: ('split', path, target) or
+        # ('link', path, target)
+        self.operations = []
+        # New path lists of the packages that are affected by the plan
+        self.package_paths = {}
+
+
+    def _getPaths(self, package):
+        if package not in self.package_paths:
+            try:
+                self.package_paths[package] = list(self.installpaths.getPaths(package))
+            except KeyError:
+                self.package_paths[package] = []
+        return self.package_paths[package]
+
+
+    def _lookup(self, paths):
+        '''Returns a dictionary mapping each of paths to (kind, target, owner)
+        for the path as it will be once the plan so far is committed, where
+        kind is 'dir', 'link', 'file' or None if nothing is there.  The owners
+        of all of the paths are looked up at once.'''
+        result = {}
+        owned_paths = []
+        for path in paths:
+            if path in self.planned:
+                result[path] = self.planned[path]
+                continue
+            try:
+                st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                result[path] = (None, None, None)
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                result[path] = ('link', os.readlink(path), None)
+                owned_paths.append(path)
+            elif stat.S_ISDIR(st.st_mode):
+                result[path] = ('dir', None, None)
+            else:
+                result[path] = ('file', None, None)
+                owned_paths.append(path)
+
+        if owned_paths:
+            owners = self.installpaths.getOwners(owned_paths)
+            for path in owned_paths:
+                kind, target, owner = result[path]
+                result[path] = (kind, target, owners.get(path))
+        return result
+
+
+    def _planSplit(self, path, target, owner):
+        # Replace the folded link at path with a directory of links to
+        # everything in target
+        self.operations.append(('split', path, target))
+        self.planned[path] = ('dir', None, None)
+        paths = self._getPaths(owner)
+        paths.remove(path)
+        paths.append(path + '/')
+        with os.scandir(target) as entries:
+            for entry in entries:
+                child = os.path.join(path, entry.name)
+                self.planned[child] = ('link', entry.path, owner)
+                paths.append(child)
+
+
+    def _planDir(self, package, srcdir, destdir, paths, conflicts):
+        with os.scandir(srcdir) as scandir_entries:
+            # .jpkg is jpkg's metadata about the package
+            entries = [e for e in scandir_entries
+                        if not (srcdir == self.srcroot and e.name == '.jpkg')]
+        states = self._lookup([os.path.join(destdir, e.name) for e in entries])
+        for entry in entries:
+            src = entry.path
+            dest = os.path.join(destdir, entry.name)
+            kind, target, owner = states[dest]
+
+            if entry.is_dir():
+                if kind is None:
+                    # Nothing there yet, so link the whole directory
+                    self.operations.append(('link', dest, src))
+                    self.planned[dest] = ('link', src, package)
+                    paths.append(dest)
+                    continue
+                elif kind == 'link' and owner is not None and owner != package \
+                            and os.path.isdir(target):
+                    self._planSplit(dest, target, owner)
+                elif kind != 'dir':
+                    conflicts.append((dest, owner))
+                    continue
+                paths.append(dest + '/')
+                self._planDir(package, src, dest, paths, conflicts)
+            else:
+                if kind is None:
+                    self.operations.append(('link', dest, src))
+                    self.planned[dest] = ('link', src, package)
+                    paths.append(dest)
+                elif owner is not None and not is_shared_file(dest):
+                    conflicts.append((dest, owner))
+                # Files that are already there but don't belong to any
+                # package are left alone
+
+
+    def planInstall(self, package, srcroot):
+        '''Plans linking everything in srcroot into usr_dir for package.
+        Returns a list of (path, owning package) for the paths that are in the
+        way; the plan is only valid if the list is empty.'''
+        self.srcroot = srcroot
+        paths = self._getPaths(package)
+        conflicts = []
+        self._planDir(package, srcroot, self.destroot, paths, conflicts)
+        return conflicts
+
+
+    def commit(self):
+        '''Makes the planned changes and records them in the installed paths
+        database.'''
+        jpkg.make_recursive_dir(self.destroot)
+        for operation, path, target in self.operations:
+            if operation == 'split':
+                os.remove(path)
+                os.mkdir(path)
+                with os.scandir(target) as entries:
+                    for entry in entries:
+                        os.symlink(entry.path, os.path.join(path, entry.name))
+            elif operation == 'link':
+                os.symlink(target, path)
+
+        for package in self.package_paths:
+            self.installpaths.addPaths(package, self.package_paths[package])
+
+        self.planned = {}
+        self.operations = []
+        self.package_paths = {}
+
+
+def install_packages(config, jbuilds):
+    '''Puts symlinks to the files of all of the given packages in usr_dir.
+    All packages are checked for conflicts, including with each other, before
+    anything is linked, and the installed paths database is written once.'''
+    installpaths = jpkg.open_install_paths(config)
+    linker = Linker(config, installpaths)
+
+    # Make sure there aren't any files that will be overwritten
+    conflicts = False
+    for jbuild in jbuilds:
+        for path, owner in linker.planInstall(jbuild.getName(), jbuild.getInstallDir()):
+            if owner is None:
+                jpkg.error('error: "%s" is in the way.  Cannot install %s.' %
+                        (path, jbuild.getName()))
+            else:
+                jpkg.error('error: file "%s" already owned by %s.  Cannot install %s.' %
+                        (path, owner, jbuild.getName()))
+            conflicts = True
+    if conflicts:
+        exit(1)
+
+    with installpaths.batch():
+        linker.commit()
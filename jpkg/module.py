@@ -1,7 +1,19 @@
+import json
 import os.path
 import glob
 
 
+# Every subpath (glob pattern) of an install directory that is searched by
+# getEnvironmentVariables, i.e. everything an environment manifest must have
+SEARCH_SUBPATHS = ['bin', 'lib32', 'lib64', 'lib', 'include',
+                   os.path.join('share','man'),
+                   os.path.join('lib*','python*','site-packages'),
+                   os.path.join('share','aclocal'),
+                   'lib/pkgconfig', 'lib32/pkgconfig', 'lib64/pkgconfig', 'share/pkgconfig',
+                   '']
+MANIFEST_VERSION = 1
+
+
 class Module:
     def __init__(self, filename=None):
         if filename is not None:
@@ -11,15 +23,51 @@ class Module:
             self.textlines = []
 
 
-    def _addPathIfExists(self, env_vars, installdir, subpaths, variable_list):
+    def getManifestFilename(self, installdir):
+        return os.path.join(installdir, '.jpkg', 'environment.json')
+
+
+    def writeManifest(self, installdir):
+        '''Saves the directories found for each search subpath in installdir,
+        so getEnvironmentVariables doesn't have to search for them again.'''
+        subpaths = {}
+        for subpath in SEARCH_SUBPATHS:
+            subpaths[subpath] = [x for x in glob.glob(os.path.join(installdir, subpath))
+                        if os.path.isdir(x)]
+        filename = self.getManifestFilename(installdir)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fid:
+            json.dump({'version' : MANIFEST_VERSION, 'subpaths' : subpaths}, fid,
+                        indent=2, sort_keys=True)
+            fid.write('\n')
+
+
+    def readManifest(self, installdir):
+        '''Returns the saved search results for installdir, or None if it
+        doesn't have a (current) manifest.'''
+        try:
+            with open(self.getManifestFilename(installdir), 'r') as fid:
+                manifest = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        return manifest['subpaths']
+
+
+    def _addPathIfExists(self, env_vars, installdir, subpaths, variable_list,
+                manifest=None):
         for subpath in subpaths:
-            fullpaths = glob.glob(os.path.join(installdir, subpath))
+            if manifest is not None and subpath in manifest:
+                fullpaths = manifest[subpath]
+            else:
+                fullpaths = [x for x in glob.glob(os.path.join(installdir, subpath))
+                            if os.path.isdir(x)]
             for fullpath in fullpaths:
-                if os.path.isdir(fullpath):
-                    for var in variable_list:
-                        if var not in env_vars:
-                            env_vars[var] = []
-                        env_vars[var].append(fullpath)
+                for var in variable_list:
+                    if var not in env_vars:
+                        env_vars[var] = []
+                    env_vars[var].append(fullpath)
 
 
     def _bashVarPrepend(self, variable, separator, items):
@@ -30,22 +78,23 @@ class Module:
 
 
     def getEnvironmentVariables(self, installdir, name=None):
+        manifest = self.readManifest(installdir)
         env_vars = {}
-        self._addPathIfExists(env_vars, installdir, ['bin'], ['PATH'])
+        self._addPathIfExists(env_vars, installdir, ['bin'], ['PATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
-                    ['lib32', 'lib64', 'lib'], ['LIBRARY_PATH', 'LD_RUN_PATH'])
+                    ['lib32', 'lib64', 'lib'], ['LIBRARY_PATH', 'LD_RUN_PATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
-                    ['include'], ['CPATH'])
+                    ['include'], ['CPATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
-                    [os.path.join('share','man')], ['MANPATH'])
+                    [os.path.join('share','man')], ['MANPATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
-                    [os.path.join('lib*','python*','site-packages')], ['PYTHONPATH'])
+                    [os.path.join('lib*','python*','site-packages')], ['PYTHONPATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
-                    [os.path.join('share','aclocal')], ['ACLOCAL_PATH', 'M4PATH'])
+                    [os.path.join('share','aclocal')], ['ACLOCAL_PATH', 'M4PATH'], manifest)
         self._addPathIfExists(env_vars, installdir,
                     ['lib/pkgconfig', 'lib32/pkgconfig', 'lib64/pkgconfig', 'share/pkgconfig'],
-                    ['PKG_CONFIG_PATH'])
-        self._addPathIfExists(env_vars, installdir, [''], ['CMAKE_PREFIX_PATH'])
+                    ['PKG_CONFIG_PATH'], manifest)
+        self._addPathIfExists(env_vars, installdir, [''], ['CMAKE_PREFIX_PATH'], manifest)
         if name is not None:
             sname = name.replace('-', '_')
             pkg_base_var = 'JPKG_PACKAGE_%s_BASE' % sname
@@ -54,9 +103,10 @@ class Module:
             pkg_lib_var = 'JPKG_PACKAGE_%s_LIB' % sname
 
             env_vars[pkg_base_var] = [installdir]
-            self._addPathIfExists(env_vars, installdir, ['bin'], [pkg_bin_var])
-            self._addPathIfExists(env_vars, installdir, ['include'], [pkg_include_var])
-            self._addPathIfExists(env_vars, installdir, ['lib','lib32','lib64'], [pkg_lib_var])
+            self._addPathIfExists(env_vars, installdir, ['bin'], [pkg_bin_var], manifest)
+            self._addPathIfExists(env_vars, installdir, ['include'], [pkg_include_var], manifest)
+            self._addPathIfExists(env_vars, installdir, ['lib','lib32','lib64'], [pkg_lib_var],
+                        manifest)
             if pkg_lib_var in env_vars:
                 # Only take the first library path found
                 env_vars[pkg_lib_var] = [env_vars[pkg_lib_var][0]]
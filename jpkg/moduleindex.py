@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import threading
+import time
+
+import jpkg
+
+
+def _lua_string(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _lmod_parse_version(version):
+    '''Approximates Lmod's parseVersion, which turns a version into a string
+    that sorts the same way the versions do.'''
+    parts = []
+    for part in re.findall(r'\d+|[a-zA-Z]+', version):
+        if part.isdigit():
+            parts.append('%09d' % int(part))
+        else:
+            parts.append('*' + part.lower())
+    return '.'.join(parts + ['*zfinal'])
+
+
+class ModuleIndex:
+    '''Index of the modulefiles that jpkg has written to modulefile_dir: the
+    name, version, description, root and environment of each one.  Saving it
+    also writes an Lmod spider cache (spiderT.lua), so that "module avail" and
+    "module spider" don't have to walk and parse modulefile_dir.'''
+
+    def __init__(self, config):
+        self.modulefile_dir = os.path.normpath(config.get('modulefile_dir'))
+        self.filename = os.path.join(config.get('database_dir'), 'module_index.json')
+        self.cache_dir = config.get('lmod_cache_dir') or \
+                    os.path.join(self.modulefile_dir, '.lmod-cache')
+        self.lock = threading.RLock()
+        self.dirty = False
+
+        self.database = {}
+        try:
+            with open(self.filename, 'r') as fid:
+                self.database = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filename = '%s.%d' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fid:
+                json.dump(self.database, fid, indent=2, sort_keys=True)
+                fid.write('\n')
+            os.replace(tmp_filename, self.filename)
+            self.writeSpiderCache()
+            self.dirty = False
+
+
+    def clear(self):
+        with self.lock:
+            self.database = {}
+            self.dirty = True
+
+
+    def addModule(self, jbuild, module_filename):
+        installdir = jbuild.getInstallDir()
+        key = os.path.relpath(module_filename, self.modulefile_dir)
+        entry = {
+            'name' : os.path.dirname(key),
+            'version' : os.path.basename(key),
+            'package' : jbuild.getNameAndVersion(),
+            'description' : jbuild.getDescription(),
+            'root' : installdir,
+            'paths' : jpkg.Module().getEnvironmentVariables(installdir),
+        }
+        with self.lock:
+            self.database[key] = entry
+            self.dirty = True
+
+
+    def removeModule(self, module_filename):
+        key = os.path.relpath(module_filename, self.modulefile_dir)
+        with self.lock:
+            if key in self.database:
+                del self.database[key]
+                self.dirty = True
+
+
+    def getModules(self):
+        '''Returns a dictionary mapping "name/version" to the index entry of
+        each module.'''
+        with self.lock:
+            return dict(self.database)
+
+
+    def writeSpiderCache(self):
+        '''Writes spiderT.lua and a timestamp file to cache_dir.  Point Lmod
+        at them with scDescriptT in lmodrc.lua.'''
+        mpath = self.modulefile_dir
+        names = {}
+        for key in sorted(self.database):
+            names.setdefault(self.database[key]['name'], []).append(key)
+
+        lines = ['timestampFn = false', 'mrcT = {}', 'mrcMpathT = {}', 'spiderT = {',
+                    '  [%s] = {' % _lua_string(mpath)]
+        for name in sorted(names):
+            lines += ['    [%s] = {' % _lua_string(name),
+                      '      defaultA = {},', '      defaultT = {},', '      dirT = {},',
+                      '      fileT = {']
+            for key in names[name]:
+                entry = self.database[key]
+                pv = _lmod_parse_version(entry['version'])
+                lines += ['        [%s] = {' % _lua_string(key),
+                          '          Description = %s,' % _lua_string(entry['description']),
+                          '          Version = %s,' % _lua_string(entry['version']),
+                          '          canonical = %s,' % _lua_string(entry['version']),
+                          '          fn = %s,' % _lua_string(os.path.join(mpath, key)),
+                          '          mpath = %s,' % _lua_string(mpath),
+                          '          pV = %s,' % _lua_string(pv),
+                          '          wV = %s,' % _lua_string(pv),
+                          '          whatis = { %s, },' % _lua_string(entry['description'])]
+                for table, variables in [('pathA', ['PATH']),
+                            ('lpathA', ['LIBRARY_PATH', 'LD_RUN_PATH'])]:
+                    paths = []
+                    for variable in variables:
+                        paths += [p for p in entry['paths'].get(variable, []) if p not in paths]
+                    if paths:
+                        lines.append('          %s = { %s },' % (table,
+                                    ' '.join(['[%s] = 1,' % _lua_string(p) for p in paths])))
+                lines.append('        },')
+            lines += ['      },', '      metaModuleT = {},', '    },']
+        lines += ['  },', '}', 'mpathMapT = {}']
+
+        jpkg.make_recursive_dir(self.cache_dir)
+        filename = os.path.join(self.cache_dir, 'spiderT.lua')
+        tmp_filename = '%s.%d' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as fid:
+            fid.write('\n'.join(lines) + '\n')
+        os.replace(tmp_filename, filename)
+        with open(os.path.join(self.cache_dir, 'timestamp'), 'w') as fid:
+            fid.write('%d\n' % time.time())
@@ -56,12 +56,21 @@ class PackageDB:
 
 
     def installPackage(self, jbuild):
-        name = jbuild.getName()
-        idx = self.getVersionIndex(name, jbuild.getVersion())
-        if idx == -1:
-            raise KeyError('%s not in package database' % jbuild.getNameAndVersion())
+        self.installPackages([jbuild])
+
+
+    def installPackages(self, jbuilds):
+        # Check all of them first so that the database is either updated for
+        # all of them or none of them
+        indices = []
+        for jbuild in jbuilds:
+            idx = self.getVersionIndex(jbuild.getName(), jbuild.getVersion())
+            if idx == -1:
+                raise KeyError('%s not in package database' % jbuild.getNameAndVersion())
+            indices.append(idx)
 
-        self.database[name][idx]['installed'] = True
+        for jbuild, idx in zip(jbuilds, indices):
+            self.database[jbuild.getName()][idx]['installed'] = True
         self.save()
 
 
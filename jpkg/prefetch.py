@@ -0,0 +1,71 @@
+import concurrent.futures
+import os
+
+
+class DistfilePrefetcher:
+    def __init__(self, config, graph, jbuilds, jobs=4):
+        # graph: DependencyGraph containing jbuilds.
+        # jbuilds: List of Jbuilds whose distfiles should be downloaded, in
+        #          topologically sorted order.
+        # jobs: Maximum number of downloads to run at the same time.
+        self.config = config
+        self.graph = graph
+        self.jbuilds = list(jbuilds)
+        self.jobs = max(1, jobs)
+        self.executor = None
+        self.futures = {}
+
+
+    def getFetchOrder(self):
+        '''Returns the jbuilds ordered so that packages at the bottom of the
+        longest chains of dependent packages come first, since everything
+        above them has to wait for them to be built.'''
+        selected = set(self.jbuilds)
+        dependents = {}
+        for jbuild in self.jbuilds:
+            dependents[jbuild] = [d for d in self.graph.getDependents(jbuild)
+                        if d in selected]
+
+        # Length of the longest chain of packages that depend on each package
+        # (including the package itself).  Dependents come later in the
+        # sorted order, so walk it backwards.
+        chain_length = {}
+        for jbuild in reversed(self.jbuilds):
+            chain_length[jbuild] = 1 + max([chain_length[d] for d in dependents[jbuild]],
+                        default=0)
+
+        order = list(range(len(self.jbuilds)))
+        order.sort(key=lambda idx: (-chain_length[self.jbuilds[idx]], idx))
+        return [self.jbuilds[idx] for idx in order]
+
+
+    def start(self):
+        '''Starts downloading all distfiles in the background.'''
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        distdir = self.config.get('distfiles_dir')
+        for jbuild in self.getFetchOrder():
+            for url, distfile in zip(jbuild.getDownloadURLs(), jbuild.getDistfiles()):
+                dest = os.path.join(distdir, distfile)
+                if dest not in self.futures:
+                    self.futures[dest] = self.executor.submit(
+                                jbuild.downloadDistfile, url, distfile, quiet=True)
+
+
+    def wait(self, jbuild):
+        '''Blocks until all of the distfiles of jbuild have been downloaded.
+        Raises the download's exception if one of them failed.'''
+        distdir = self.config.get('distfiles_dir')
+        for url, distfile in zip(jbuild.getDownloadURLs(), jbuild.getDistfiles()):
+            dest = os.path.join(distdir, distfile)
+            if dest in self.futures:
+                self.futures[dest].result()
+            else:
+                jbuild.downloadDistfile(url, distfile)
+
+
+    def shutdown(self):
+        '''Cancels any downloads that have not started yet and waits for the
+        running ones to finish.'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+import jpkg
+
+
+class RepoIndex:
+    '''Persistent index of the repository: package name -> sorted versions,
+    and jbuild spec -> parsed jbuild.  Entries are checked against the mtime
+    of the package directory or jbuild file the first time they are used in a
+    process, and only the entries that changed are re-read.'''
+
+    def __init__(self, config):
+        self.repodir = config.get('repository_dir')
+        self.filename = os.path.join(config.get('database_dir'), 'repo_index.json')
+        self.lock = threading.RLock()
+        self.dirty = False
+
+        # Names and jbuild specs that have been checked against the
+        # filesystem by this process
+        self.checked_names = set()
+        self.checked_jbuilds = set()
+
+        self.database = {}
+        try:
+            with open(self.filename, 'r') as fid:
+                self.database = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            pass
+        if self.database.get('repository_dir') != self.repodir:
+            self.database = {
+                'repository_dir' : self.repodir,
+                'packages' : {},
+                'jbuilds' : {},
+            }
+            self.dirty = True
+
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filename = '%s.%d' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fid:
+                json.dump(self.database, fid, sort_keys=True)
+                fid.write('\n')
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+
+
+    def getVersions(self, name):
+        '''Returns the versions of package name in the repository, sorted from
+        oldest to newest, or an empty list if there is no such package.'''
+        with self.lock:
+            packages = self.database['packages']
+            if name in self.checked_names:
+                return packages[name]['versions'] if name in packages else []
+
+            self.checked_names.add(name)
+            package_dir = os.path.join(self.repodir, name)
+            try:
+                mtime = os.stat(package_dir).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                if name in packages:
+                    self._removePackage(name)
+                return []
+
+            if name in packages and packages[name]['mtime'] == mtime:
+                return packages[name]['versions']
+
+            versions = []
+            for f in os.listdir(package_dir):
+                if f[-7:] == '.jbuild' and f.startswith(name + '-'):
+                    versions.append(f[len(name)+1:-7])
+            jpkg.sort_versions(versions)
+
+            if name in packages:
+                for version in packages[name]['versions']:
+                    if version not in versions:
+                        self.database['jbuilds'].pop(
+                                    os.path.join(name, '%s-%s' % (name, version)), None)
+            packages[name] = {'mtime' : mtime, 'versions' : versions}
+            self.dirty = True
+            return versions
+
+
+    def _removePackage(self, name):
+        for version in self.database['packages'][name]['versions']:
+            self.database['jbuilds'].pop(os.path.join(name, '%s-%s' % (name, version)), None)
+        del self.database['packages'][name]
+        self.dirty = True
+
+
+    def getJbuildData(self, jbuild_spec, parse):
+        '''Returns the parsed contents of the jbuild jbuild_spec (e.g.
+        "vim/vim-8.0.0005").  parse(text) is called to parse the jbuild if it
+        isn't in the index or has changed.'''
+        with self.lock:
+            jbuilds = self.database['jbuilds']
+            if jbuild_spec in self.checked_jbuilds:
+                return jbuilds[jbuild_spec]['data']
+
+            jbuild_path = os.path.join(self.repodir, jbuild_spec + '.jbuild')
+            st = os.stat(jbuild_path)
+            entry = jbuilds.get(jbuild_spec)
+            if entry is None or entry['mtime'] != st.st_mtime_ns \
+                        or entry['size'] != st.st_size:
+                with open(jbuild_path, 'r') as fid:
+                    data = parse(fid.read())
+                entry = {'mtime' : st.st_mtime_ns, 'size' : st.st_size, 'data' : data}
+                jbuilds[jbuild_spec] = entry
+                self.dirty = True
+
+            self.checked_jbuilds.add(jbuild_spec)
+            return entry['data']
@@ -0,0 +1,89 @@
+import concurrent.futures
+import traceback
+
+import jpkg
+
+
+class BuildScheduler:
+    def __init__(self, graph, jbuilds, jobs=1):
+        # graph: DependencyGraph containing jbuilds.
+        # jbuilds: List of Jbuilds to build, in topologically sorted order.
+        #          Dependencies that are not in jbuilds are assumed to be built
+        #          already.
+        # jobs: Maximum number of packages to build at the same time.
+        self.jbuilds = list(jbuilds)
+        self.jobs = max(1, jobs)
+
+        self.order = {}
+        for idx, jbuild in enumerate(self.jbuilds):
+            self.order[jbuild] = idx
+
+        self.waiting_on = {}
+        self.dependents = {}
+        for jbuild in self.jbuilds:
+            self.waiting_on[jbuild] = set([d for d in graph.getDependencies(jbuild)
+                        if d in self.order])
+            self.dependents[jbuild] = [d for d in graph.getDependents(jbuild)
+                        if d in self.order]
+
+        self.built = []
+        self.failed = []
+        self.skipped = []
+
+
+    def run(self, build_func, on_success=None):
+        '''Calls build_func(jbuild) for every jbuild as soon as all of its
+        dependencies have been built, with up to self.jobs calls running at
+        once.  on_success(jbuild) is called from the calling thread after each
+        successful build.  After the first failure no new builds are started,
+        but builds that are already running are allowed to finish.  Returns
+        True if every package was built.'''
+        ready = [jbuild for jbuild in self.jbuilds if not self.waiting_on[jbuild]]
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while running or (ready and not self.failed):
+                while ready and not self.failed and len(running) < self.jobs:
+                    jbuild = ready.pop(0)
+                    running[executor.submit(build_func, jbuild)] = jbuild
+
+                done, not_done = concurrent.futures.wait(running,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    jbuild = running.pop(future)
+                    try:
+                        future.result()
+                        if on_success is not None:
+                            on_success(jbuild)
+                    except (Exception, SystemExit) as e:
+                        # BuildErrors have been reported already, and so have
+                        # errors that helpers exited for, which mustn't
+                        # abandon the builds that are still running
+                        if not isinstance(e, (jpkg.BuildError, SystemExit)):
+                            traceback.print_exc()
+                            jpkg.error('error: failed to build %s.' \
+                                        % jbuild.getNameAndVersion())
+                        self.failed.append(jbuild)
+                        continue
+
+                    self.built.append(jbuild)
+                    for dependent in self.dependents[jbuild]:
+                        self.waiting_on[dependent].discard(jbuild)
+                        if not self.waiting_on[dependent]:
+                            ready.append(dependent)
+                    ready.sort(key=lambda j: self.order[j])
+
+        for jbuild in self.jbuilds:
+            if jbuild not in self.built and jbuild not in self.failed:
+                self.skipped.append(jbuild)
+
+        return not self.failed and not self.skipped
+
+
+    def printSummary(self):
+        print('\nBuild summary:')
+        for label, jbuilds in [('built', self.built),
+                               ('failed', self.failed),
+                               ('skipped', self.skipped)]:
+            names = ' '.join([j.getNameAndVersion() for j in jbuilds])
+            print(' '*2 + '%-8s (%d) %s' % (label + ':', len(jbuilds), names))
@@ -0,0 +1,72 @@
+import os
+import shutil
+import threading
+
+import jpkg
+
+
+# Guesses used when a package has no build history
+DISTFILE_EXPANSION_FACTOR = 10
+# Margin added to the largest workdir seen in previous builds
+HISTORY_MARGIN = 1.25
+
+# Space promised to builds that are running in this process, by scratch root
+_reserved = {}
+_lock = threading.Lock()
+
+
+def get_scratch_roots(config):
+    '''Returns the directories that workdirs can be placed in, fastest first.
+    tmp_dir is always the last resort.'''
+    roots = list(config.get('scratch_dirs'))
+    if config.get('tmp_dir') not in roots:
+        roots.append(config.get('tmp_dir'))
+    return roots
+
+
+def estimate_build_footprint(config, jbuild):
+    '''Estimates how many bytes the workdir of jbuild will need at its
+    largest, from previous builds if there are any and from the size of the
+    distfiles otherwise.'''
+    history = jpkg.BuildHistory(config.getWorkdirSizesFile())
+    sizes = [r['workdir_size'] for r in history.getRecords(jbuild.getName())
+                if r['workdir_size']]
+    if sizes:
+        return int(HISTORY_MARGIN * max(sizes[-5:]))
+
+    size = 0
+    for distfile in jbuild.getDistfiles():
+        try:
+            size += os.stat(os.path.join(config.get('distfiles_dir'), distfile)).st_size
+        except FileNotFoundError:
+            pass
+    return DISTFILE_EXPANSION_FACTOR * size
+
+
+def reserve_scratch_root(config, jbuild):
+    '''Picks the first scratch root with enough free space for jbuild's
+    workdir, taking into account the other builds running in this process.
+    Returns (root, reserved bytes); pass both to release_scratch_root when
+    the workdir has been removed.'''
+    size = estimate_build_footprint(config, jbuild)
+    roots = get_scratch_roots(config)
+    with _lock:
+        for root in roots:
+            try:
+                jpkg.make_recursive_dir(root)
+                if not os.access(root, os.W_OK):
+                    continue
+                free = shutil.disk_usage(root).free - _reserved.get(root, 0)
+            except OSError:
+                continue
+            if free >= size or root == roots[-1]:
+                _reserved[root] = _reserved.get(root, 0) + size
+                return root, size
+
+        # tmp_dir wasn't usable either; let the build report the error
+        return roots[-1], 0
+
+
+def release_scratch_root(root, size):
+    with _lock:
+        _reserved[root] = _reserved.get(root, 0) - size
@@ -0,0 +1,187 @@
+import bisect
+import json
+import os
+import re
+import threading
+import time
+
+import jpkg
+
+
+# Seconds that the index is trusted for without checking every package, as
+# long as no package has been added to or removed from the repository
+CHECK_INTERVAL = 300
+
+
+def tokenize(text):
+    return set(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+class SearchIndex:
+    '''Persistent inverted index from the words in the name, description and
+    homepage of the newest version of each package in the repository to the
+    package names.  update() only checks the packages when the repository
+    directory has changed or CHECK_INTERVAL has passed, and then only reads
+    the packages whose package directory or newest jbuild changed, so
+    searching a large repository takes milliseconds.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.repodir = config.get('repository_dir')
+        self.filename = os.path.join(config.get('database_dir'), 'search_index.json')
+        self.lock = threading.RLock()
+        self.dirty = False
+
+        self.database = {}
+        try:
+            with open(self.filename, 'r') as fid:
+                self.database = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            pass
+        if self.database.get('repository_dir') != self.repodir:
+            self.database = {
+                'repository_dir' : self.repodir,
+                'packages' : {},
+                'tokens' : {},
+            }
+            self.dirty = True
+        self.sorted_tokens = None
+
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filename = '%s.%d' % (self.filename, os.getpid())
+            with open(tmp_filename, 'w') as fid:
+                json.dump(self.database, fid, sort_keys=True)
+                fid.write('\n')
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+
+
+    def _removePackage(self, name):
+        tokens = self.database['tokens']
+        for token in self.database['packages'][name]['tokens']:
+            tokens[token].remove(name)
+            if not tokens[token]:
+                del tokens[token]
+        del self.database['packages'][name]
+        self.sorted_tokens = None
+        self.dirty = True
+
+
+    def _addPackage(self, name, entry):
+        tokens = self.database['tokens']
+        for token in entry['tokens']:
+            tokens.setdefault(token, []).append(name)
+        self.database['packages'][name] = entry
+        self.sorted_tokens = None
+        self.dirty = True
+
+
+    def _isUnchanged(self, name, entry, package_mtime):
+        if entry is None or entry.get('mtime') != package_mtime:
+            return False
+        jbuild_path = os.path.join(self.repodir, name,
+                    '%s-%s.jbuild' % (name, entry['version']))
+        try:
+            st = os.stat(jbuild_path)
+        except FileNotFoundError:
+            return False
+        return entry.get('jbuild_stat') == [st.st_mtime_ns, st.st_size]
+
+
+    def update(self, refresh=False):
+        '''Brings the index up to date with the repository.  Unless refresh
+        is True, nothing is checked if the repository directory hasn't
+        changed since the last check less than CHECK_INTERVAL seconds ago.'''
+        try:
+            repo_mtime = os.stat(self.repodir).st_mtime_ns
+        except FileNotFoundError:
+            repo_mtime = None
+        with self.lock:
+            if not refresh and repo_mtime == self.database.get('repository_mtime') \
+                        and time.time() - self.database.get('checked', 0) < CHECK_INTERVAL:
+                return
+
+            packages = self.database['packages']
+            try:
+                names = set([n for n in os.listdir(self.repodir) if not n.startswith('.')])
+            except FileNotFoundError:
+                names = set()
+
+            for name in list(packages):
+                if name not in names:
+                    self._removePackage(name)
+
+            index = None
+            for name in sorted(names):
+                try:
+                    package_mtime = os.stat(os.path.join(self.repodir, name)).st_mtime_ns
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                if self._isUnchanged(name, packages.get(name), package_mtime):
+                    continue
+
+                if name in packages:
+                    self._removePackage(name)
+                if index is None:
+                    index = self.config.getRepoIndex()
+                versions = index.getVersions(name)
+                if not versions:
+                    continue
+                jbuild_path = os.path.join(self.repodir, name,
+                            '%s-%s.jbuild' % (name, versions[-1]))
+                try:
+                    jbuild = jpkg.Jbuild(self.config, '=%s-%s' % (name, versions[-1]))
+                    st = os.stat(jbuild_path)
+                except (ValueError, OSError) as e:
+                    # Leave the package out rather than make every search fail
+                    jpkg.error('error: cannot read %s: %s' % (jbuild_path, e))
+                    continue
+                entry = {
+                    'version' : versions[-1],
+                    'description' : jbuild.getDescription(),
+                    'homepage' : jbuild.getHomepage(),
+                    'mtime' : package_mtime,
+                    'jbuild_stat' : [st.st_mtime_ns, st.st_size],
+                }
+                entry['tokens'] = sorted(tokenize(name) | tokenize(entry['description'])
+                            | tokenize(entry['homepage']) | set([name.lower()]))
+                self._addPackage(name, entry)
+
+            self.database['repository_mtime'] = repo_mtime
+            self.database['checked'] = time.time()
+            self.dirty = True
+        if index is not None:
+            index.save()
+
+
+    def search(self, terms):
+        '''Returns the sorted names of the packages that match all of terms.  A
+        term matches a package if it's part of its name or the beginning of a
+        word in its name, description or homepage.'''
+        with self.lock:
+            tokens = self.database['tokens']
+            if self.sorted_tokens is None:
+                self.sorted_tokens = sorted(tokens)
+
+            result = None
+            for term in terms:
+                term = term.lower()
+                matches = set([n for n in self.database['packages'] if term in n.lower()])
+                idx = bisect.bisect_left(self.sorted_tokens, term)
+                while idx < len(self.sorted_tokens) \
+                            and self.sorted_tokens[idx].startswith(term):
+                    matches.update(tokens[self.sorted_tokens[idx]])
+                    idx += 1
+                result = matches if result is None else result & matches
+            return sorted(result or [])
+
+
+    def getPackage(self, name):
+        '''Returns the version, description and homepage of the newest version
+        of package name.'''
+        with self.lock:
+            return self.database['packages'].get(name)
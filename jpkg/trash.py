@@ -0,0 +1,252 @@
+import atexit
+import collections
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import jpkg
+
+
+TRASH_DIRNAME = '.jpkg-trash'
+# Deleting pauses for THROTTLE_PAUSE seconds after every THROTTLE_BATCH
+# entries, so that it doesn't swamp a shared filesystem
+THROTTLE_BATCH = 500
+THROTTLE_PAUSE = 0.05
+# Suffix of the file next to an entry in the trash that holds the record to
+# log with the entry's size once it's deleted
+RECORD_SUFFIX = '.jpkg-record'
+
+
+def remove_tree_throttled(path, pause=THROTTLE_PAUSE, stop=None):
+    '''Removes the directory tree at path, ignoring errors.  If the
+    threading.Event stop is set, it stops early.  Returns (total size of the
+    files that were removed, whether all of the tree was removed).'''
+    count = 0
+    size = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            filename = os.path.join(root, name)
+            try:
+                size += os.lstat(filename).st_size
+                os.unlink(filename)
+            except OSError:
+                pass
+            count += 1
+            if count >= THROTTLE_BATCH:
+                count = 0
+                if stop is not None and stop.is_set():
+                    return size, False
+                if pause:
+                    time.sleep(pause)
+        for name in dirs:
+            subpath = os.path.join(root, name)
+            try:
+                if os.path.islink(subpath):
+                    os.unlink(subpath)
+                else:
+                    os.rmdir(subpath)
+            except OSError:
+                pass
+    # Anything that couldn't be removed above, e.g. in read-only directories
+    shutil.rmtree(path, ignore_errors=True)
+    return size, True
+
+
+def write_record(trash_path, log_filename, record, removed_size=0):
+    tmp_filename = '%s%s.tmp.%d' % (trash_path, RECORD_SUFFIX, os.getpid())
+    with open(tmp_filename, 'w') as fid:
+        json.dump({'log' : log_filename, 'record' : record,
+                   'removed_size' : removed_size}, fid)
+    os.replace(tmp_filename, trash_path + RECORD_SUFFIX)
+
+
+def finish_record(trash_path, removed_size):
+    '''Logs the record of a deleted trash entry, if it has one, with the
+    total size of the files that were deleted.'''
+    # Claim the record first, in case another process is deleting the same
+    # trash, so that it's only logged once
+    record_filename = '%s%s.%d' % (trash_path, RECORD_SUFFIX, os.getpid())
+    try:
+        os.rename(trash_path + RECORD_SUFFIX, record_filename)
+        with open(record_filename, 'r') as fid:
+            data = json.load(fid)
+    except (FileNotFoundError, ValueError):
+        return
+    finally:
+        if os.path.isfile(record_filename):
+            os.remove(record_filename)
+    record = dict(data['record'])
+    record['workdir_size'] = data['removed_size'] + removed_size
+    jpkg.BuildHistory(data['log']).append(record)
+
+
+def list_trash(trash_dir):
+    '''Returns the entries in trash_dir that are still to be deleted, after
+    logging the records of entries that are already gone.'''
+    try:
+        names = set(os.listdir(trash_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    entries = []
+    for name in sorted(names):
+        if name.endswith(RECORD_SUFFIX):
+            if name[:-len(RECORD_SUFFIX)] not in names:
+                finish_record(os.path.join(trash_dir, name[:-len(RECORD_SUFFIX)]), 0)
+        elif RECORD_SUFFIX not in name:
+            entries.append(os.path.join(trash_dir, name))
+    return entries
+
+
+class Trash:
+    '''Removes workdirs in the background.  A workdir is renamed into a trash
+    directory next to it, which is instant, and a background thread deletes
+    the contents of the trash.  Whatever is left when jpkg exits is deleted by
+    a detached process, and trash left by a jpkg that was killed is deleted
+    the next time the trash is started.
+
+    The size of each workdir is measured as it's deleted and can be logged
+    with a record, whichever process finishes deleting it.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.max_size = jpkg.parse_size(config.get('trash_max_size'))
+        self.condition = threading.Condition()
+        self.queue = collections.deque() # (path, size)
+        self.queued_size = 0
+        self.removing = None
+        self.thread = None
+        self.stop = threading.Event()
+        self.counter = itertools.count()
+
+
+    def getTrashDirs(self):
+        return [os.path.join(root, TRASH_DIRNAME)
+                    for root in jpkg.get_scratch_roots(self.config)]
+
+
+    def start(self):
+        '''Starts the background thread and queues the trash left by earlier
+        runs.'''
+        with self.condition:
+            if self.thread is not None:
+                return
+            for trash_dir in self.getTrashDirs():
+                for path in list_trash(trash_dir):
+                    self.queue.append((path, 0))
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.finish)
+
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stop.is_set():
+                    self.condition.wait()
+                if self.stop.is_set():
+                    return # the rest is left to the detached process
+                path, size = self.queue[0]
+                self.removing = path
+            removed_size, done = remove_tree_throttled(path, stop=self.stop)
+            try:
+                if done:
+                    finish_record(path, removed_size)
+                elif os.path.isfile(path + RECORD_SUFFIX):
+                    # Let the detached process add the rest
+                    with open(path + RECORD_SUFFIX, 'r') as fid:
+                        data = json.load(fid)
+                    write_record(path, data['log'], data['record'],
+                                data['removed_size'] + removed_size)
+            except (OSError, ValueError):
+                pass # losing a record only makes estimates worse
+            with self.condition:
+                self.removing = None
+                if not done:
+                    self.condition.notify_all()
+                    return
+                self.queue.popleft()
+                self.queued_size -= size
+                self.condition.notify_all()
+
+
+    def remove(self, path, size=0, record=None):
+        '''Removes the directory at path, whose contents take about size bytes
+        (or an unknown amount if 0).  It's removed right away if it can't be
+        renamed into the trash, or if the trash already holds trash_max_size
+        bytes.  If record is given as (log filename, dictionary), the
+        dictionary is appended to the log with the measured size of the files
+        as "workdir_size" once they're deleted.'''
+        with self.condition:
+            has_room = self.max_size > 0 and self.queued_size + size <= self.max_size
+        if has_room:
+            trash_dir = os.path.join(os.path.dirname(path), TRASH_DIRNAME)
+            trash_path = os.path.join(trash_dir, '%s.%d.%d' % (os.path.basename(path),
+                        os.getpid(), next(self.counter)))
+            try:
+                jpkg.make_recursive_dir(trash_dir)
+                if record is not None:
+                    write_record(trash_path, record[0], record[1])
+                os.rename(path, trash_path)
+            except OSError:
+                try:
+                    os.remove(trash_path + RECORD_SUFFIX)
+                except OSError:
+                    pass
+            else:
+                self.start()
+                with self.condition:
+                    self.queue.append((trash_path, size))
+                    self.queued_size += size
+                    self.condition.notify_all()
+                return
+
+        removed_size, done = remove_tree_throttled(path, pause=0)
+        if os.path.lexists(path):
+            jpkg.recursive_remove_dir(path) # reports what couldn't be removed
+        if record is not None:
+            jpkg.BuildHistory(record[0]).append(dict(record[1], workdir_size=removed_size))
+
+
+    def finish(self):
+        '''Hands the trash over to a detached process if it isn't empty, so
+        that jpkg can exit without waiting for it.'''
+        with self.condition:
+            if not self.queue:
+                return
+            # Have the thread stop soon and save how much it has deleted of
+            # the workdir it's working on
+            self.stop.set()
+            self.condition.notify_all()
+            while self.removing is not None:
+                self.condition.wait()
+        trash_dirs = [d for d in self.getTrashDirs() if os.path.isdir(d)]
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(jpkg.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([package_dir] +
+                    ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        subprocess.Popen([sys.executable, '-m', 'jpkg.trash'] + trash_dirs, env=env,
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def main(trash_dirs):
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+    for trash_dir in trash_dirs:
+        for path in list_trash(trash_dir):
+            removed_size, done = remove_tree_throttled(path)
+            try:
+                finish_record(path, removed_size)
+            except (OSError, ValueError):
+                pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
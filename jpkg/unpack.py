@@ -0,0 +1,143 @@
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tarfile
+import zipfile
+
+import jpkg
+
+
+TAR_SUFFIXES = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz', '.tar.xz', '.txz']
+ZIP_SUFFIXES = ['.zip']
+
+
+def is_supported_archive(filename):
+    for suffix in TAR_SUFFIXES + ZIP_SUFFIXES:
+        if filename.endswith(suffix):
+            return True
+    return False
+
+
+def extract_archive(filename, destination):
+    if filename.endswith(tuple(ZIP_SUFFIXES)):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                archive.extract(info, destination)
+                # zipfile doesn't restore permissions (e.g. executable bits)
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(os.path.join(destination, info.filename), mode)
+    else:
+        with tarfile.open(filename, 'r:*') as archive:
+            if hasattr(tarfile, 'tar_filter'):
+                archive.extractall(destination, filter='tar')
+            else:
+                archive.extractall(destination)
+
+
+class SourceUnpacker:
+    '''Unpacks the distfiles of a package into its workdir without running
+    bash.  If source_cache_dir is set, each distfile is extracted once into a
+    cache of pristine source trees (keyed by the distfile's checksum), and
+    workdirs are populated by cloning the cached trees.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.cache_dir = config.get('source_cache_dir')
+        self.clone_method = config.get('source_cache_clone')
+
+
+    def canUnpack(self, jbuild):
+        distfiles = jbuild.getDistfiles()
+        return len(distfiles) > 0 and all([is_supported_archive(f) for f in distfiles])
+
+
+    def getCachedTree(self, jbuild, distfile):
+        '''Returns the directory containing the extracted contents of distfile,
+        extracting it first if it's not in the cache.'''
+        path = os.path.join(self.config.get('distfiles_dir'), distfile)
+        tree = os.path.join(self.cache_dir, jbuild.getDistfileDigest(distfile))
+        if os.path.isdir(tree):
+            os.utime(tree) # the modification time orders trees for eviction
+            return tree
+
+        jpkg.make_recursive_dir(self.cache_dir)
+        tmp_tree = '%s.%d.%d.part' % (tree, os.getpid(), id(self))
+        if os.path.isdir(tmp_tree):
+            jpkg.recursive_remove_dir(tmp_tree)
+        os.mkdir(tmp_tree)
+        extract_archive(path, tmp_tree)
+        try:
+            os.rename(tmp_tree, tree)
+        except OSError:
+            # Another build extracted the same distfile first
+            if not os.path.isdir(tree):
+                raise
+            jpkg.recursive_remove_dir(tmp_tree)
+        return tree
+
+
+    def collectGarbage(self, max_size, dry_run=False):
+        '''Removes the least recently used source trees until the cache is no
+        bigger than max_size bytes.  Returns a list of (tree, size) of the
+        removed trees.'''
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return []
+
+        trees = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not entry.name.endswith('.part'):
+                    trees.append((entry.stat().st_mtime, entry.path,
+                                jpkg.get_tree_size(entry.path)[0]))
+        trees.sort()
+        total = sum([size for mtime, tree, size in trees])
+
+        evicted = []
+        for mtime, tree, size in trees:
+            if total <= max_size:
+                break
+            evicted.append((tree, size))
+            total -= size
+            if not dry_run:
+                jpkg.recursive_remove_dir(tree)
+        return evicted
+
+
+    def cloneTree(self, tree, workdir):
+        '''Copies the contents of tree into workdir.'''
+        if self.clone_method == 'hardlink':
+            def link_or_copy(src, dst):
+                try:
+                    os.link(src, dst)
+                except OSError: # e.g. cache and workdir on different filesystems
+                    shutil.copy2(src, dst)
+            shutil.copytree(tree, workdir, symlinks=True, dirs_exist_ok=True,
+                        copy_function=link_or_copy)
+        else:
+            # GNU cp makes copy-on-write clones where the filesystem supports it
+            try:
+                returncode = subprocess.call(['cp', '-a', '--reflink=auto',
+                            os.path.join(tree, '.'), workdir], stderr=subprocess.DEVNULL)
+            except FileNotFoundError:
+                returncode = 1
+            if returncode != 0:
+                shutil.copytree(tree, workdir, symlinks=True, dirs_exist_ok=True)
+
+
+    def unpack(self, jbuild, workdir):
+        distfiles = jbuild.getDistfiles()
+        distdir = self.config.get('distfiles_dir')
+        if self.cache_dir:
+            # Each distfile is extracted into its own tree, so they can be
+            # extracted at the same time
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(distfiles)) as executor:
+                trees = list(executor.map(lambda f: self.getCachedTree(jbuild, f), distfiles))
+            for tree in trees:
+                self.cloneTree(tree, workdir)
+        else:
+            # One at a time, since tarfile and zipfile fail when two of them
+            # create the same parent directory at once
+            for distfile in distfiles:
+                extract_archive(os.path.join(distdir, distfile), workdir)
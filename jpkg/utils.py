@@ -1,91 +1,217 @@
-import distutils.version
+import collections
+import hashlib
 import os
-import subprocess
+import re
 import shutil
+import stat
 import sys
-import urllib.request
+import time
 
 import jpkg
 
 
 def get_jbuild_fullname(config, name):
-    repodir = config.get('repository_dir')
+    index = config.getRepoIndex()
 
+    jfullname = None
     if name[0] == '=':
+        # The name itself may contain hyphens, so try every split point
         sn = name[1:].split('-')
-        isfound = False
-        for i in range(len(sn), 0, -1):
-            n = ''.join(sn[0:i])
-            jfullname = os.path.join(n, name[1:])
-            jpath = os.path.join(repodir, jfullname+'.jbuild')
-            if os.path.isfile(jpath):
-                isfound = True
+        for i in range(len(sn)-1, 0, -1):
+            n = '-'.join(sn[0:i])
+            if '-'.join(sn[i:]) in index.getVersions(n):
+                jfullname = os.path.join(n, name[1:])
                 break
     else:
-        possibilities = []
-        for f in os.listdir(os.path.join(repodir, name)):
-            if f[-7:] == '.jbuild':
-                possibilities.append(f[:-7])
-        sort_versions(possibilities)
-        jfullname = os.path.join(name, possibilities[-1])
-        jpath = os.path.join(repodir, jfullname+'.jbuild')
-
-    if not os.path.isfile(jpath):
-        jpkg.error('error: package %s does not exist.' % name)
-        exit(1)
+        versions = index.getVersions(name)
+        if versions:
+            jfullname = os.path.join(name, '%s-%s' % (name, versions[-1]))
+
+    if jfullname is None:
+        message = 'error: package %s does not exist.' % name
+        jpkg.error(message)
+        raise jpkg.BuildError(message)
 
     return jfullname
 
 
-def get_dependencies(config, jbuild, jbuilds=[], dependencies=[]):
-    deps = jbuild.getDependencies()
-    jbuilds.append(jbuild)
-    dependencies.append([])
-    for dep in deps:
-        dependencies[-1].append(jpkg.Jbuild(config, dep))
-    for dep in deps:
-        get_dependencies(config, jpkg.Jbuild(config, dep),
-                    jbuilds, dependencies)
-    return jbuilds, dependencies
+def get_dependencies(config, jbuilds):
+    '''Returns a DependencyGraph of jbuilds and everything they depend on,
+    directly or indirectly.  Each jbuild is only expanded once.'''
+    graph = jpkg.DependencyGraph()
+    resolved = {} # dependency spec (e.g. "zlib") -> jbuild
+
+    queue = collections.deque()
+    for jbuild in jbuilds:
+        if jbuild not in graph:
+            queue.append(graph.addNode(jbuild))
+
+    while queue:
+        jbuild = queue.popleft()
+        for dep in jbuild.getDependencies():
+            if dep not in resolved:
+                resolved[dep] = jpkg.Jbuild(config, dep)
+            is_new = resolved[dep] not in graph
+            dep_jbuild = graph.addNode(resolved[dep])
+            graph.addEdge(jbuild, dep_jbuild)
+            if is_new:
+                queue.append(dep_jbuild)
+
+    return graph
+
+
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+DOWNLOAD_ATTEMPTS = 3 # per URL, as long as each attempt makes progress
+
+
+def _download_url(url, tmp_destination_filename, quiet, algorithms):
+    '''Downloads url into tmp_destination_filename, continuing from the end
+    of the file if it already exists.  Returns a dictionary mapping each of
+    algorithms to the hex digest of the whole file.'''
+    # Imported here because they're slow to import and most commands don't
+    # download anything
+    import http.client
+    import urllib.error
+    import urllib.request
+
+    hashers = dict([(a, hashlib.new(a)) for a in algorithms])
+    def hash_existing_file():
+        with open(tmp_destination_filename, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(DOWNLOAD_CHUNK_SIZE), b''):
+                for h in hashers.values():
+                    h.update(chunk)
+
+    offset = 0
+    if os.path.isfile(tmp_destination_filename):
+        offset = os.path.getsize(tmp_destination_filename)
 
+    request = urllib.request.Request(url)
+    if offset > 0 and request.type in ('http', 'https'):
+        request.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        response = urllib.request.urlopen(request, timeout=30)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # Nothing left to download
+            hash_existing_file()
+            return dict([(a, h.hexdigest()) for a, h in hashers.items()])
+        raise
 
-def download_file(url, destination=None):
-    '''Download a file from the given URL.'''
+    with response:
+        # file:// and ftp:// responses have no status, and always start from
+        # the beginning of the file
+        if offset > 0 and getattr(response, 'status', None) != 206:
+            offset = 0 # the server doesn't support ranges, so start over
+        if offset > 0:
+            hash_existing_file()
+        total = response.headers.get('Content-Length')
+        if total is not None:
+            total = int(total) + offset
+
+        downloaded = 0
+        last_report = time.time()
+        with open(tmp_destination_filename, 'ab' if offset > 0 else 'wb') as fid:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                fid.write(chunk)
+                for h in hashers.values():
+                    h.update(chunk)
+                downloaded += len(chunk)
+                if not quiet and time.time() - last_report >= 1:
+                    last_report = time.time()
+                    sys.stdout.write('\r    %s of %s' % (format_size(offset + downloaded),
+                                format_size(total) if total is not None else '?'))
+                    sys.stdout.flush()
+        if not quiet and downloaded >= DOWNLOAD_CHUNK_SIZE:
+            sys.stdout.write('\n')
+
+        if total is not None and offset + downloaded < total:
+            raise http.client.IncompleteRead(b'', total - offset - downloaded)
+    return dict([(a, h.hexdigest()) for a, h in hashers.items()])
+
+
+def download_file(url, destination=None, quiet=False, mirrors=[], digests={}):
+    '''Download a file from the given URL, trying each of the mirrors (base
+    URLs that the file's name is appended to) first.  An interrupted download
+    is continued the next time from where it stopped.  If quiet is True, no
+    progress is printed.
+
+    digests maps hash algorithms (e.g. "sha256") to the expected hex digest
+    of the file; a source whose file doesn't match is skipped.  Returns a
+    dictionary of the digests of the downloaded file, which always includes
+    sha256.  Raises BuildError if no source could be downloaded.'''
     destination_filename = destination
     if not destination:
         destination_filename = os.path.basename(url)
     tmp_destination_filename = destination_filename + '.part'
+    algorithms = sorted(set(['sha256']) | set(digests))
 
-    for method in ['wget', 'curl', 'python']:
-        if method == 'wget':
+    urls = [m.rstrip('/') + '/' + os.path.basename(destination_filename) for m in mirrors]
+    urls.append(url)
+
+    start_time = time.time()
+    resumed_from = 0
+    if os.path.isfile(tmp_destination_filename):
+        resumed_from = os.path.getsize(tmp_destination_filename)
+    actual_digests = None
+    for source_url in urls:
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            size_before = os.path.getsize(tmp_destination_filename) \
+                        if os.path.isfile(tmp_destination_filename) else 0
             try:
-                returncode = subprocess.call(['wget', url,
-                            '-O', tmp_destination_filename])
-            except FileNotFoundError:
-                returncode = 1
-            if returncode == 0:
+                actual_digests = _download_url(source_url, tmp_destination_filename,
+                            quiet, algorithms)
                 break
-        elif method == 'curl':
-            try:
-                returncode = subprocess.call(['curl', '-L', url,
-                            '-o', tmp_destination_filename])
-            except FileNotFoundError:
-                returncode = 1
-            if returncode == 0:
+            except Exception as e:
+                exception = e
+                if not os.path.isfile(tmp_destination_filename) or \
+                            os.path.getsize(tmp_destination_filename) <= size_before:
+                    break # no progress, so try the next URL
+
+        if actual_digests is not None:
+            mismatched = [a for a in digests if digests[a].lower() != actual_digests[a]]
+            if not mismatched:
                 break
-        elif method == 'python':
-            try:
-                with open(tmp_destination_filename, 'wb') as fid_destination:
-                    fid_url = urllib.request.urlopen(url, timeout=30)
-                    fid_destination.write(fid_url.read())
-                    fid_url.close()
-            except:
-                jpkg.error('Failed to download file:\n')
-                jpkg.error('    %s\n' % url)
-                jpkg.error('ABORTING\n')
-                raise
+            exception = jpkg.ChecksumError('%s checksum of "%s" from %s does not match' \
+                        % (', '.join(mismatched), os.path.basename(destination_filename),
+                        source_url))
+            jpkg.error('error: %s.' % exception)
+            os.remove(tmp_destination_filename)
+            actual_digests = None
+    else:
+        jpkg.error('Failed to download file:\n')
+        for source_url in urls:
+            jpkg.error('    %s\n' % source_url)
+        jpkg.error('ABORTING\n')
+        if isinstance(exception, jpkg.BuildError):
+            raise exception
+        raise jpkg.BuildError('failed to download "%s": %s' \
+                    % (os.path.basename(destination_filename), exception)) from exception
 
+    size = os.path.getsize(tmp_destination_filename)
     os.rename(tmp_destination_filename, destination_filename)
+    if quiet:
+        return actual_digests
+    elapsed = max(time.time() - start_time, 1e-3)
+    print('Downloaded "%s" (%s at %s/s%s)' % (os.path.basename(destination_filename),
+                format_size(size), format_size(max(size - resumed_from, 0) / elapsed),
+                ', resumed from %s' % format_size(resumed_from) if resumed_from else ''))
+    return actual_digests
+
+
+def file_digests(filename, algorithms):
+    '''Returns a dictionary mapping each of algorithms to the hex digest of
+    the contents of a file, reading it once.'''
+    hashers = dict([(a, hashlib.new(a)) for a in algorithms])
+    with open(filename, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1024*1024), b''):
+            for h in hashers.values():
+                h.update(chunk)
+    return dict([(a, h.hexdigest()) for a, h in hashers.items()])
+
+
+def file_digest(filename, algorithm='sha256'):
+    '''Returns the hex digest of the contents of a file.'''
+    return file_digests(filename, [algorithm])[algorithm]
 
 
 def yesno_prompt(message, default=None):
@@ -100,9 +226,26 @@ def yesno_prompt(message, default=None):
         return False
 
 
+_VERSION_COMPONENT_RE = re.compile(r'(\d+|[a-z]+|\.)')
+
+
+def version_key(version):
+    '''Sort key that orders versions the same way as distutils'
+    LooseVersion, except that numbers sort before letters instead of not
+    being comparable.'''
+    key = []
+    for component in _VERSION_COMPONENT_RE.split(version):
+        if component and component != '.':
+            try:
+                key.append((0, int(component)))
+            except ValueError:
+                key.append((1, component))
+    return key
+
+
 def sort_versions(version_list):
     '''sorts version_list by version number (in place)'''
-    version_list.sort(key=distutils.version.LooseVersion)
+    version_list.sort(key=version_key)
 
 
 def make_recursive_dir(directory):
@@ -122,6 +265,39 @@ def recursive_remove_dir(directory):
     shutil.rmtree(directory, onerror=_remove_readonly)
 
 
+def get_tree_size(directory):
+    '''Returns (total size in bytes, number of files) of everything under
+    directory, without following symlinks.'''
+    size = 0
+    nfiles = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+                nfiles += 1
+            except FileNotFoundError:
+                pass
+    return size, nfiles
+
+
+def format_size(nbytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if nbytes < 1024:
+            return '%.1f%s' % (nbytes, unit)
+        nbytes /= 1024
+    return '%.1fTiB' % nbytes
+
+
+def parse_size(size):
+    '''Converts a size such as "500M" or "20G" (or a number of bytes) to a
+    number of bytes.'''
+    size = str(size).strip().upper()
+    units = {'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def is_trailing_path_equal(n, path1, path2):
     path1n = os.path.normpath(path1)
     path2n = os.path.normpath(path2)
@@ -27,5 +27,5 @@ setup(name = "jpkg",
     #It says, package *needs* these files.
     #package_data = {'jpkg' : files },
 
-    scripts = ["jpkg-build"],
+    scripts = ["jpkg-build", "jpkg-query"],
 )